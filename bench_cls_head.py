@@ -0,0 +1,55 @@
+import time
+import torch
+import torch.nn as nn
+from model import classifiers, feature_channels
+import parallel
+import argparse
+
+# parameters, Adam state and training step time of the classifier heads
+# (random backbone features), at several input sizes
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--b', type=int, default=16)  # batch size
+parser.add_argument('--n', type=int, default=10)  # timed steps
+parser.add_argument('--sizes', default='256,320,384')  # input sizes, the features are --os times smaller
+parser.add_argument('--cpu', action='store_true')  # run on the cpu even if cuda is available
+opt = parser.parse_args()
+print(opt)
+
+device = parallel.get_device(opt.cpu)
+channels = feature_channels[opt.i]
+criterion = nn.CrossEntropyLoss()
+lbl = torch.zeros(opt.b, dtype=torch.long, device=device)
+
+
+def step(head, optimizer, feats):
+    loss = criterion(head(feats), lbl)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+
+print('%-7s %12s %14s %6s %10s' % ('head', 'params (M)', 'adam (MB)', 'size', 'ms/step'))
+for name, cls in sorted(classifiers.items()):
+    head = cls(opt.i, output_stride=opt.os).to(device)
+    optimizer = torch.optim.Adam(head.parameters(), lr=1e-3)
+    params = sum(p.numel() for p in head.parameters())
+    for size in [int(s) for s in opt.sizes.split(',')]:
+        feats = torch.randn(opt.b, channels, size // opt.os, size // opt.os, device=device)
+        try:
+            step(head, optimizer, feats)
+        except RuntimeError:
+            # the linear head only takes 256x256 inputs
+            print('%-7s %12.2f %14.1f %6d %10s' % (name, params / 1e6, 8.0 * params / 2 ** 20, size, '-'))
+            continue
+        if 'cuda' == device.type:
+            torch.cuda.synchronize()
+        t = time.time()
+        for i in range(opt.n):
+            step(head, optimizer, feats)
+        if 'cuda' == device.type:
+            torch.cuda.synchronize()
+        print('%-7s %12.2f %14.1f %6d %10.1f' % (name, params / 1e6, 8.0 * params / 2 ** 20, size,
+                                                1000 * (time.time() - t) / opt.n))
@@ -0,0 +1,87 @@
+import os
+import time
+import cv2
+import numpy as np
+import torch
+from crf import dense_crf, lowres_crf, band_crf
+from convcrf import conv_crf
+from guided import guided_refine
+from dataset import MyTestData
+from myfunc import iou
+import argparse
+
+# accuracy/speed of the reduced CRF modes, the batched convcrf and the
+# guided filter against the full-resolution CRF, on the probability maps
+# written by test.py for a validation set
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--img_root', default='/home/zeng/data/datasets/oxhand/val/images')
+parser.add_argument('--map_root', default='/home/zeng/data/datasets/oxhand/val/seg')  # hand probability maps (.png)
+parser.add_argument('--gt_root', default='/home/zeng/data/datasets/oxhand/val/masks')  # ground truth masks (.png)
+parser.add_argument('--scales', default='0.5,0.25')  # 'lowres' resolutions to compare
+parser.add_argument('--margins', default='0.3,0.45')  # 'band' margins to compare
+parser.add_argument('--radius', type=int, default=8)
+parser.add_argument('--compat', type=float, default=3)
+parser.add_argument('--gf_r', default='8')  # guided filter radii to compare
+parser.add_argument('--gf_eps', type=float, default=0.1)  # guided filter regularization (normalized image units)
+parser.add_argument('--n', type=int, default=0)  # number of images, 0: all
+opt = parser.parse_args()
+print(opt)
+
+methods = [('none', None), ('full', lambda img, probs: dense_crf(img, probs, compat=opt.compat))]
+for scale in [float(x) for x in opt.scales.split(',') if x]:
+    methods.append(('lowres %.2f' % scale,
+                    lambda img, probs, scale=scale: lowres_crf(img, probs, scale=scale, compat=opt.compat)))
+for margin in [float(x) for x in opt.margins.split(',') if x]:
+    methods.append(('band %.2f' % margin,
+                    lambda img, probs, margin=margin: band_crf(img, probs, margin=margin, radius=opt.radius,
+                                                               compat=opt.compat)))
+
+
+
+def as_tensors(img, probs):
+    # the torch refiners see the image normalized like the network input
+    img = (img[:, :, ::-1] / 255.0 - MyTestData.mean) / MyTestData.std
+    img = torch.from_numpy(img.transpose(2, 0, 1).copy()).float().unsqueeze(0)
+    return img, torch.from_numpy(probs).float().unsqueeze(0)
+
+
+def torch_method(fn, **kwargs):
+    def run(img, probs):
+        with torch.no_grad():
+            return fn(*as_tensors(img, probs), **kwargs)[0].numpy()
+    return run
+
+
+methods.append(('conv', torch_method(conv_crf, compat=opt.compat)))
+for r in [int(x) for x in opt.gf_r.split(',') if x]:
+    methods.append(('guided %d' % r, torch_method(guided_refine, r=r, eps=opt.gf_eps)))
+
+files = sorted([name for name in os.listdir(opt.img_root) if name.endswith('.jpg')])
+if opt.n > 0:
+    files = files[:opt.n]
+
+times = dict((name, 0.0) for name, _ in methods)
+ious = dict((name, []) for name, _ in methods)
+agree = dict((name, []) for name, _ in methods)
+for img_name in files:
+    img = cv2.imread(os.path.join(opt.img_root, img_name))
+    prob = cv2.imread(os.path.join(opt.map_root, img_name[:-4] + '.png'), 0).astype('float') / 255
+    prob = cv2.resize(prob, (img.shape[1], img.shape[0]))
+    gt = cv2.imread(os.path.join(opt.gt_root, img_name[:-4] + '.png'), 0)
+    gt = cv2.resize(gt, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST) > 0
+    probs = np.stack((1 - prob, prob), 0)
+    results = {}
+    for name, fn in methods:
+        t = time.time()
+        Q = probs if fn is None else fn(img, probs)
+        times[name] += time.time() - t
+        results[name] = Q[1] >= 0.5
+        ious[name].append(iou(results[name], gt))
+    for name, _ in methods:
+        agree[name].append(iou(results[name], results['full']))
+
+print('%-12s %10s %10s %12s' % ('method', 'ms/image', 'IoU', 'IoU vs full'))
+for name, _ in methods:
+    print('%-12s %10.1f %10.4f %12.4f' % (name, 1000 * times[name] / len(files),
+                                          np.mean(ious[name]), np.mean(agree[name])))
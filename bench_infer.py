@@ -0,0 +1,64 @@
+import time
+import torch
+import torch.nn as nn
+from model import build_feature, Deconv
+from inference import prepare_inference
+from checkpoint import load_weights
+import parallel
+import argparse
+
+# outputs and speed of the inference SegNet (BatchNorm folded, no Dropout)
+# against the training modules in eval mode
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='resnet')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32
+parser.add_argument('--seg_head', default='full')  # Deconv layers, see model.seg_head
+parser.add_argument('--ckpt', default='')  # training checkpoint, default: random weights and BatchNorm statistics
+parser.add_argument('--b', type=int, default=4)  # batch size
+parser.add_argument('--n', type=int, default=10)  # timed batches
+parser.add_argument('--tol', type=float, default=1e-4)  # largest accepted difference of the probabilities
+parser.add_argument('--cpu', action='store_true')  # run on the cpu even if cuda is available
+opt = parser.parse_args()
+print(opt)
+
+device = parallel.get_device(opt.cpu)
+feature = build_feature(opt.i, output_stride=opt.os).to(device)
+deconv = Deconv(opt.i, opt.seg_head, opt.os).to(device)
+if opt.ckpt:
+    load_weights(feature, opt.ckpt, 'feature', device)
+    load_weights(deconv, opt.ckpt, 'deconv', device)
+else:
+    # statistics away from the identity, so that folding is actually tested
+    for m in feature.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+feature.eval()
+deconv.eval()
+net = prepare_inference(feature, deconv)
+x = torch.randn(opt.b, 3, 256, 256, device=device)
+
+
+def run(fn):
+    with torch.no_grad():
+        out = fn(x)
+        if 'cuda' == device.type:
+            torch.cuda.synchronize()
+        t = time.time()
+        for i in range(opt.n):
+            fn(x)
+        if 'cuda' == device.type:
+            torch.cuda.synchronize()
+    return out, 1000 * (time.time() - t) / opt.n
+
+
+ref, t_ref = run(lambda x: torch.softmax(deconv(feature(x)), 1))
+out, t_out = run(net)
+err = (out - ref).abs().max().item()
+print('BatchNorm layers: %d -> %d' % (sum(isinstance(m, nn.BatchNorm2d) for m in feature.modules()),
+                                      sum(isinstance(m, nn.BatchNorm2d) for m in net.modules())))
+print('ms/batch: %.1f -> %.1f, max difference %.2e' % (t_ref, t_out, err))
+assert err <= opt.tol, 'outputs differ by %.2e' % err
@@ -0,0 +1,72 @@
+import time
+import torch
+import torch.nn.functional as functional
+from torch.autograd.graph import saved_tensors_hooks
+from criterion import seg_losses
+from model import Deconv, feature_channels
+import parallel
+import argparse
+
+# memory and time of the 'full' and 'down' segmentation losses on a training
+# step of Deconv (random backbone features and labels)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--seg_head', default='full')  # Deconv layers: 'full', 'sep' (separable fc6), 'slim' (256 channels) or 'aspp' (ASPP-lite)
+parser.add_argument('--b', type=int, default=48)  # batch size
+parser.add_argument('--n', type=int, default=10)  # timed steps
+parser.add_argument('--cpu', action='store_true')  # run on the cpu even if cuda is available
+opt = parser.parse_args()
+print(opt)
+
+device = parallel.get_device(opt.cpu)
+channels = feature_channels[opt.i]
+deconv = Deconv(opt.i, opt.seg_head, opt.os).to(device)
+feats = torch.randn(opt.b, channels, 256 // opt.os, 256 // opt.os, device=device)
+lbl = (torch.rand(opt.b, 256, 256, device=device) < 0.1).long()
+weight = torch.FloatTensor([1, 25])
+
+
+def step(criterion, full):
+    msk = deconv(feats)
+    if full:
+        msk = functional.upsample(msk, scale_factor=opt.os)
+    loss = criterion(msk, lbl)
+    deconv.zero_grad()
+    loss.backward()
+    return loss.item()
+
+
+def saved_bytes(criterion, full):
+    # bytes of the tensors autograd keeps for backward (each storage once)
+    seen = {}
+
+    def pack(x):
+        seen[(x.untyped_storage().data_ptr(), x.device)] = x.untyped_storage().nbytes()
+        return x
+    with saved_tensors_hooks(pack, lambda x: x):
+        step(criterion, full)
+    return sum(seen.values())
+
+
+print('%-6s %10s %14s %14s %10s' % ('loss', 'value', 'saved (MB)', 'peak (MB)', 'ms/step'))
+for name, cls in sorted(seg_losses.items()):
+    criterion = cls(weight=weight).to(device)
+    full = 'full' == name
+    torch.manual_seed(0)
+    deconv.train()
+    value = step(criterion, full)
+    saved = saved_bytes(criterion, full) / 2.0 ** 20
+    peak = float('nan')
+    if 'cuda' == device.type:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        step(criterion, full)
+        peak = torch.cuda.max_memory_allocated() / 2.0 ** 20
+    t = time.time()
+    for i in range(opt.n):
+        step(criterion, full)
+    if 'cuda' == device.type:
+        torch.cuda.synchronize()
+    print('%-6s %10.6f %14.1f %14.1f %10.1f' % (name, value, saved, peak, 1000 * (time.time() - t) / opt.n))
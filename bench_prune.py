@@ -0,0 +1,58 @@
+import os
+import torch
+from dataset import MyBoxPixData, MyData
+from criterion import seg_losses
+from model import build_feature, Deconv
+from checkpoint import atomic_save
+from prune import prune_units, taylor_saliency, prune, load_pruned, evaluate
+import parallel
+import argparse
+from os.path import expanduser
+home = expanduser("~")
+
+# prune a trained model at several sparsities (prune.py): every pruned model
+# is saved (fine-tune it with train.py --f and --d) and its size, speed and
+# validation IoU are reported, before fine-tuning
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32
+parser.add_argument('--seg_head', default='full')  # Deconv layers: 'full', 'slim' or 'sep'
+parser.add_argument('--ckpt', required=True)  # trained model (training checkpoint)
+parser.add_argument('--train_dir', default='%s/data/datasets/oxhand/train'%home)  # calibration data
+parser.add_argument('--val_dir', default='%s/data/datasets/oxhand/val'%home)  # images and masks for the IoU
+parser.add_argument('--check_dir', default='./parameters_pruned')  # pruned models, pruned-<sparsity>.pth
+parser.add_argument('--sparsity', default='0.25,0.5,0.75')  # fractions of the channels to remove
+parser.add_argument('--n', type=int, default=20)  # calibration batches
+parser.add_argument('--nv', type=int, default=0)  # validation batches, 0: all
+parser.add_argument('--b', type=int, default=16)  # batch size
+parser.add_argument('--cpu', action='store_true')  # run on the cpu even if cuda is available
+opt = parser.parse_args()
+print(opt)
+
+device = parallel.get_device(opt.cpu)
+if not os.path.exists(opt.check_dir):
+    os.mkdir(opt.check_dir)
+feature = build_feature(opt.i, output_stride=opt.os).to(device)
+load_pruned(feature, opt.ckpt, 'feature', device)
+deconv = Deconv(opt.i, opt.seg_head, opt.os).to(device)
+load_pruned(deconv, opt.ckpt, 'deconv', device)
+
+calib = torch.utils.data.DataLoader(MyBoxPixData(opt.train_dir, transform=True), batch_size=opt.b,
+                                    shuffle=True, num_workers=4)
+val = torch.utils.data.DataLoader(MyData(opt.val_dir, transform=True), batch_size=opt.b,
+                                  shuffle=False, num_workers=4)
+criterion = seg_losses['full'](weight=torch.FloatTensor([1, 25])).to(device)
+units = prune_units(feature, deconv)
+scores = taylor_saliency(feature, deconv, calib, units, criterion, device, opt.n)
+nv = opt.nv or len(val)
+
+print('%-8s %12s %10s %10s' % ('sparsity', 'params (M)', 'ms/batch', 'IoU'))
+for sparsity in [0.0] + [float(s) for s in opt.sparsity.split(',')]:
+    f, d = prune(feature, deconv, scores, sparsity)
+    ms, score = evaluate(f.eval(), d.eval(), val, device, nv)
+    params = sum(p.numel() for p in list(f.parameters()) + list(d.parameters()))
+    print('%-8.2f %12.2f %10.1f %10.4f' % (sparsity, params / 1e6, ms, score))
+    if sparsity > 0:
+        atomic_save({'models': {'feature': f.state_dict(), 'deconv': d.state_dict()}},
+                    '%s/pruned-%.2f.pth' % (opt.check_dir, sparsity))
@@ -0,0 +1,72 @@
+import io
+import torch
+from dataset import MyBoxPixData, MyData
+from model import build_feature, Deconv, nothing
+from inference import prepare_inference
+from prune import load_pruned, evaluate
+import quant
+import argparse
+from os.path import expanduser
+home = expanduser("~")
+
+# size, cpu speed and validation IoU of a trained float model, of its
+# post-training quantized (calibrated) int8 version and of the int8 model
+# exported by train.py --qat
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32
+parser.add_argument('--seg_head', default='full')  # Deconv layers, see model.seg_head
+parser.add_argument('--ckpt', required=True)  # trained float model (training checkpoint)
+parser.add_argument('--qat', default='')  # int8 model of train.py --qat (check_dir/int8.pt), '': leave out
+parser.add_argument('--train_dir', default='%s/data/datasets/oxhand/train'%home)  # calibration data
+parser.add_argument('--val_dir', default='%s/data/datasets/oxhand/val'%home)  # images and masks for the IoU
+parser.add_argument('--n', type=int, default=20)  # calibration batches
+parser.add_argument('--nv', type=int, default=0)  # validation batches, 0: all
+parser.add_argument('--b', type=int, default=16)  # batch size
+parser.add_argument('--backend', default='x86')  # quantized engine: 'x86' or 'fbgemm'
+opt = parser.parse_args()
+print(opt)
+
+# int8 kernels only run on the cpu
+device = torch.device('cpu')
+feature = build_feature(opt.i, output_stride=opt.os)
+load_pruned(feature, opt.ckpt, 'feature', device)
+deconv = Deconv(opt.i, opt.seg_head, opt.os)
+load_pruned(deconv, opt.ckpt, 'deconv', device)
+feature.eval()
+deconv.eval()
+
+calib = torch.utils.data.DataLoader(MyBoxPixData(opt.train_dir, transform=True), batch_size=opt.b,
+                                    shuffle=True, num_workers=4)
+val = torch.utils.data.DataLoader(MyData(opt.val_dir, transform=True), batch_size=opt.b,
+                                  shuffle=False, num_workers=4)
+nv = opt.nv or len(val)
+
+
+def calib_batches():
+    for ib, (img, lbl) in enumerate(calib):
+        if ib == opt.n:
+            break
+        yield img
+
+
+def size(model):
+    # MB of the saved weights
+    f = io.BytesIO()
+    if isinstance(model, quant.Int8Net):
+        torch.jit.save(model.model, f)
+    else:
+        torch.save(model.state_dict(), f)
+    return f.tell() / 2.0 ** 20
+
+
+ptq = quant.convert_int8(quant.calibrate(quant.prepare_ptq(feature, deconv, opt.backend), calib_batches()))
+models = [('float', prepare_inference(feature, deconv)), ('ptq', quant.Int8Net(ptq))]
+if opt.qat:
+    models.append(('qat', quant.Int8Net(quant.load_int8(opt.qat, opt.backend))))
+
+print('%-6s %10s %10s %10s' % ('model', 'size (MB)', 'ms/batch', 'IoU'))
+for name, model in models:
+    ms, score = evaluate(model, nothing, val, device, nv)
+    print('%-6s %10.1f %10.1f %10.4f' % (name, size(model), ms, score))
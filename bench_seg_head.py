@@ -0,0 +1,87 @@
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from model import build_feature, feature_channels, Deconv
+from dataset import MyData
+from checkpoint import load_weights
+from myfunc import iou
+import parallel
+import argparse
+
+# cost of the Deconv heads on the features of each backbone (256x256 input, --os):
+# parameters, multiply-adds, forward time, and the validation IoU of trained
+# checkpoints
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg,resnet,densenet')  # backbones
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--heads', default='full,sep,slim,aspp')  # Deconv heads
+parser.add_argument('--ckpts', default='')  # training checkpoints to measure the IoU of, e.g. 'vgg/slim=path/to/checkpoint.pth,vgg/full=...'
+parser.add_argument('--val_dir', default='/home/zeng/data/datasets/oxhand/val')  # images and masks for the IoU
+parser.add_argument('--b', type=int, default=16)  # batch size
+parser.add_argument('--n', type=int, default=20)  # timed batches
+parser.add_argument('--cpu', action='store_true')  # run on the cpu even if cuda is available
+opt = parser.parse_args()
+print(opt)
+
+device = parallel.get_device(opt.cpu)
+ckpts = dict(c.split('=', 1) for c in opt.ckpts.split(',') if c)
+
+
+def count_macs(module, x):
+    # multiply-adds of the convolutions for one input
+    macs = [0]
+
+    def hook(m, inputs, out):
+        macs[0] += out.numel() * m.in_channels // m.groups * m.kernel_size[0] * m.kernel_size[1]
+    handles = [m.register_forward_hook(hook) for m in module.modules() if isinstance(m, nn.Conv2d)]
+    with torch.no_grad():
+        module(x[:1])
+    for h in handles:
+        h.remove()
+    return macs[0]
+
+
+def forward_ms(module, x):
+    with torch.no_grad():
+        module(x)
+        if 'cuda' == device.type:
+            torch.cuda.synchronize()
+        t = time.time()
+        for i in range(opt.n):
+            module(x)
+        if 'cuda' == device.type:
+            torch.cuda.synchronize()
+    return 1000 * (time.time() - t) / opt.n
+
+
+def val_iou(iii, head, filename):
+    feature = build_feature(iii, output_stride=opt.os).to(device)
+    load_weights(feature, filename, 'feature', device)
+    deconv = Deconv(iii, head, opt.os).to(device)
+    load_weights(deconv, filename, 'deconv', device)
+    feature.eval()
+    deconv.eval()
+    loader = torch.utils.data.DataLoader(MyData(opt.val_dir, transform=True), batch_size=opt.b,
+                                         shuffle=False, num_workers=4)
+    ious = []
+    with torch.no_grad():
+        for img, gt in loader:
+            msk = deconv(feature(img.to(device)))
+            msk = nn.functional.interpolate(msk, size=gt.shape[1:], mode='bilinear', align_corners=False)
+            pred = msk.argmax(1).cpu().numpy()
+            ious += [iou(p, g) for p, g in zip(pred, gt.numpy())]
+    return np.mean(ious)
+
+
+print('%-9s %-5s %12s %10s %14s %8s' % ('backbone', 'head', 'params (M)', 'GMACs', 'ms/batch', 'IoU'))
+for iii in opt.i.split(','):
+    feats = torch.randn(opt.b, feature_channels[iii], 256 // opt.os, 256 // opt.os, device=device)
+    for head in opt.heads.split(','):
+        deconv = Deconv(iii, head, opt.os).to(device).eval()
+        params = sum(p.numel() for p in deconv.parameters())
+        key = '%s/%s' % (iii, head)
+        score = val_iou(iii, head, ckpts[key]) if key in ckpts else float('nan')
+        print('%-9s %-5s %12.2f %10.2f %14.1f %8.4f' % (iii, head, params / 1e6, count_macs(deconv, feats) / 1e9,
+                                                        forward_ms(deconv, feats), score))
@@ -0,0 +1,75 @@
+import torch
+import torch.utils.data as data
+from dataset import MyTestData, MyData
+from model import build_feature, Deconv, nothing
+from inference import prepare_inference
+from prune import load_pruned, evaluate
+from myfunc import iou
+import quant
+import argparse
+from os.path import expanduser
+home = expanduser("~")
+
+# post-training static quantization: the observers of a trained float model
+# see --n test images, the int8 model is saved as TorchScript (test.py --int8)
+# and compared with the float one on other --nv test images (and on --val_dir)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32
+parser.add_argument('--seg_head', default='full')  # Deconv layers, see model.seg_head
+parser.add_argument('--ckpt', default='')  # full training checkpoint, used instead of --feat and --deconv
+parser.add_argument('--feat', default='')  # backbone weights
+parser.add_argument('--deconv', default='')  # Deconv weights
+parser.add_argument('--test_dir', default='%s/data/datasets/oxhand/test'%home)  # images (MyTestData) for calibration and comparison
+parser.add_argument('--val_dir', default='')  # images and masks for the IoU of both models, '': only compare them
+parser.add_argument('--out', default='./int8.pt')  # the int8 model
+parser.add_argument('--n', type=int, default=300)  # calibration images
+parser.add_argument('--nv', type=int, default=100)  # held-out images for the comparison
+parser.add_argument('--b', type=int, default=16)  # batch size
+parser.add_argument('--backend', default='x86')  # quantized engine: 'x86' or 'fbgemm' (older cpus)
+parser.add_argument('--max_drop', type=float, default=0)  # fail if the IoU (with --val_dir) or the agreement drops more, 0: only report
+opt = parser.parse_args()
+print(opt)
+
+# int8 kernels only run on the cpu
+device = torch.device('cpu')
+feature = build_feature(opt.i, output_stride=opt.os)
+load_pruned(feature, opt.ckpt or opt.feat, 'feature', device)
+deconv = Deconv(opt.i, opt.seg_head, opt.os)
+load_pruned(deconv, opt.ckpt or opt.deconv, 'deconv', device)
+feature.eval()
+deconv.eval()
+
+# disjoint random calibration and comparison images
+images = MyTestData(opt.test_dir, transform=True)
+perm = torch.randperm(len(images), generator=torch.Generator().manual_seed(0)).tolist()
+assert len(perm) > opt.n, 'fewer than --n images in --test_dir'
+calib = data.DataLoader(data.Subset(images, perm[:opt.n]), batch_size=opt.b, num_workers=4)
+held = data.DataLoader(data.Subset(images, perm[opt.n:opt.n + opt.nv]), batch_size=opt.b, num_workers=4)
+
+prepared = quant.calibrate(quant.prepare_ptq(feature, deconv, opt.backend), (img for img, name, size in calib))
+int8 = quant.convert_int8(prepared)
+quant.save_int8(int8, opt.out)
+print('int8 model: %s' % opt.out)
+
+# accuracy loss: the hand masks of the int8 model against the float ones
+ref = prepare_inference(feature, deconv)
+net = quant.Int8Net(int8)
+agree, diff = [], 0.0
+with torch.no_grad():
+    for img, name, size in held:
+        p, q = ref(img), net(img)
+        diff = max(diff, (p - q).abs().max().item())
+        agree += [iou(a, b) for a, b in zip(q.argmax(1).numpy(), p.argmax(1).numpy())]
+drop = 1 - sum(agree) / max(len(agree), 1)
+print('%d images: mask IoU int8 vs float %.4f, max probability difference %.3f' % (len(agree), 1 - drop, diff))
+if opt.val_dir:
+    val = data.DataLoader(MyData(opt.val_dir, transform=True), batch_size=opt.b, num_workers=4)
+    ms_f, iou_f = evaluate(ref, nothing, val, device, len(val))
+    ms_q, iou_q = evaluate(net, nothing, val, device, len(val))
+    drop = iou_f - iou_q
+    print('validation IoU: float %.4f (%.1f ms/batch), int8 %.4f (%.1f ms/batch), drop %.4f'
+          % (iou_f, ms_f, iou_q, ms_q, drop))
+print('accuracy drop: %.4f (%s)' % (drop, 'validation IoU' if opt.val_dir else '1 - mask IoU int8 vs float'))
+assert not opt.max_drop or drop <= opt.max_drop, 'int8 accuracy drops by %.4f' % drop
@@ -0,0 +1,166 @@
+import os
+import glob
+import time
+import random
+import threading
+import numpy as np
+import torch
+import parallel
+
+
+def to_cpu(obj):
+    # copy of a (nested) state dict with every tensor moved to the cpu
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        out = type(obj)((k, to_cpu(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            # module state dicts carry their version info here
+            out._metadata = obj._metadata
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, filename):
+    # write to a temp file and rename, so a crash never leaves a torn checkpoint
+    tmp = '%s.tmp' % filename
+    torch.save(obj, tmp)
+    os.replace(tmp, filename)
+
+
+def find_checkpoint(check_dir, epoch):
+    # the one with the highest step
+    files = glob.glob('%s/checkpoint-epoch-%d-step-*.pth' % (check_dir, epoch))
+    return max(files, key=lambda f: int(f[:-4].rsplit('-', 1)[1])) if files else None
+
+
+def load_weights(module, filename, key, map_location=None):
+    """
+    load the weights of `module` from a full checkpoint (entry `key`, e.g.
+    'feature') or from a file holding its plain state_dict
+    """
+    sd = torch.load(filename, map_location=map_location, weights_only=False)
+    if 'models' in sd and isinstance(sd['models'], dict):
+        sd = sd['models'][key]
+    module.load_state_dict(sd)
+
+
+class Checkpointer(object):
+    """
+    one file per save with the state of the models, the optimizers, the
+    random generators of every rank and the training progress
+    the state is copied to the cpu on the calling thread, serialization and
+    writing (temp file + rename) run in a background thread, so training
+    goes on while the file is written. at most one save is in flight.
+    models, optimizers: dicts of name -> module / optimizer
+    every, minutes: due() asks for a save every `every` steps and/or when
+        `minutes` have passed since the last save (0: never)
+    """
+    def __init__(self, models, optimizers, every=0, minutes=0):
+        self.models = dict((k, parallel.unwrap(m)) for k, m in models.items())
+        self.optimizers = optimizers
+        self.every = every
+        self.minutes = minutes
+        self.steps = 0
+        self.last = time.time()
+        self.thread = None
+        self.error = None
+
+    def due(self):
+        # call once per training step on every rank
+        self.steps += 1
+        due = self.every > 0 and self.steps % self.every == 0
+        if self.minutes > 0:
+            due = due or time.time() - self.last >= 60 * self.minutes
+            # clocks differ between ranks and save() is collective, rank 0 decides
+            due = parallel.broadcast_object(due)
+        return due
+
+    def state(self, **progress):
+        # collective when distributed: every rank contributes its rng state
+        return {'models': dict((k, to_cpu(m.state_dict())) for k, m in self.models.items()),
+                'optimizers': dict((k, to_cpu(o.state_dict())) for k, o in self.optimizers.items()),
+                'rng': parallel.all_gather_object(rng_state()),
+                'progress': progress}
+
+    def save(self, filename, **progress):
+        """
+        call on every rank, only rank 0 writes
+        progress: e.g. epoch and step, returned by load()
+        """
+        state = self.state(**progress)
+        self.last = time.time()
+        if not parallel.is_main_process():
+            return
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state, filename))
+        self.thread.start()
+
+    def _write(self, state, filename):
+        try:
+            atomic_save(state, filename)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    close = wait
+
+    def load(self, filename):
+        """
+        restore models, optimizers and the rng state of this rank
+        returns the progress dict given to save()
+        """
+        # load_state_dict moves the tensors to the devices of the models
+        # and optimizers, the rng states have to stay on the cpu
+        state = torch.load(filename, map_location='cpu', weights_only=False)
+        for k, m in self.models.items():
+            m.load_state_dict(state['models'][k])
+        for k, o in self.optimizers.items():
+            if k in state['optimizers']:
+                o.load_state_dict(state['optimizers'][k])
+            else:
+                # e.g. a checkpoint with one optimizer per module
+                print('resume: no state for optimizer %s, starting it afresh' % k)
+        rng = state['rng']
+        set_rng_state(rng[parallel.get_rank()] if len(rng) == parallel.get_world_size() else rng[0])
+        return state['progress']
+
+    def resume(self, check_dir, epoch):
+        """
+        load the latest checkpoint saved during or at the end of `epoch`.
+        without one, fall back to the per-module files of older runs
+        (weights only)
+        """
+        filename = find_checkpoint(check_dir, epoch)
+        if filename is not None:
+            print('resume: %s' % filename)
+            return self.load(filename)
+        for k, m in self.models.items():
+            files = glob.glob('%s/%s-epoch-%d*.pth' % (check_dir, k, epoch))
+            m.load_state_dict(torch.load(files[0], map_location='cpu'))
+        print('resume: weights of epoch %d only, optimizer and rng states are not restored' % epoch)
+        return {'epoch': epoch}
@@ -0,0 +1,57 @@
+import torch
+import torch.nn.functional as F
+
+
+def _unfold(x, k):
+    # N x C x h x w -> N x C x k*k x h*w, zero padded
+    N, C = x.shape[:2]
+    return F.unfold(x, k, padding=k // 2).view(N, C, k * k, -1)
+
+
+def _kernel(feats, k):
+    # gaussian kernel between every pixel and its k x k window, without the
+    # padding and the pixel itself, symmetrically normalized
+    N, _, h, w = feats.shape
+    kernel = torch.exp(-0.5 * ((_unfold(feats, k) - feats.view(N, -1, 1, h * w)) ** 2).sum(1))
+    kernel = kernel * _unfold(feats.new_ones(1, 1, h, w), k)[:, 0]
+    kernel[:, k * k // 2] = 0
+    norm = kernel.sum(1).clamp(min=1e-10).view(N, 1, h, w)
+    kernel = kernel * (norm.view(N, 1, -1) * _unfold(norm, k)[:, 0]).clamp(min=1e-20).rsqrt()
+    return kernel.unsqueeze(1)
+
+
+def conv_crf(imgs, probs, sdims=(80, 80), schan=(13, 13, 13), compat=1, n_iter=5,
+             gsdims=(3, 3), gcompat=0, filter_size=11, blur=4):
+    """
+    locally connected mean-field CRF (ConvCRF) on a whole batch, on the
+    device of the inputs. same Potts model and knobs as crf.dense_crf
+    (bilateral kernel, symmetric normalization), plus an optional spatial
+    gaussian kernel (gsdims, gcompat; off by default like dense_crf), but
+    every pixel only exchanges messages within a filter_size x filter_size
+    window of the image downsampled by `blur`, i.e. filter_size*blur pixels wide.
+    imgs: N x C x H x W images
+    probs: N x L x H x W softmax probabilities
+    returns the N x L x H x W marginals
+    """
+    N, L, H, W = probs.shape
+    C = imgs.size(1)
+    k = filter_size
+    unary = -torch.log(probs.clamp(min=1e-5))
+
+    # bilateral features at the blurred resolution
+    col = F.avg_pool2d(imgs, blur, ceil_mode=True)
+    h, w = col.shape[2:]
+    ys = (torch.arange(h, device=imgs.device, dtype=imgs.dtype) + 0.5) * blur
+    xs = (torch.arange(w, device=imgs.device, dtype=imgs.dtype) + 0.5) * blur
+    pos = torch.stack((ys.view(-1, 1).expand(h, w), xs.view(1, -1).expand(h, w))).expand(N, 2, h, w)
+    col = col / col.new_tensor(schan[:C]).view(1, C, 1, 1)
+    kernel = compat * _kernel(torch.cat((pos / pos.new_tensor(sdims).view(1, 2, 1, 1), col), 1), k)
+    if gcompat:
+        kernel = kernel + gcompat * _kernel(pos / pos.new_tensor(gsdims).view(1, 2, 1, 1), k)
+
+    Q = F.softmax(-unary, dim=1)
+    for i in range(n_iter):
+        msg = (_unfold(F.avg_pool2d(Q, blur, ceil_mode=True), k) * kernel).sum(2).view(N, L, h, w)
+        msg = F.interpolate(msg, size=(H, W), mode='bilinear', align_corners=False)
+        Q = F.softmax(-unary + msg, dim=1)
+    return Q
@@ -0,0 +1,33 @@
+import torch
+from model import Classifier, PooledClassifier
+from checkpoint import atomic_save
+import argparse
+
+# turn the weights of a Classifier into the ones of a PooledClassifier
+# (PooledClassifier.init_from), either in a full training checkpoint or in a
+# plain classifier state_dict
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--src', required=True)  # training checkpoint or classifier state dict
+parser.add_argument('--dst', required=True)  # converted file, same kind as --src
+opt = parser.parse_args()
+print(opt)
+
+sd = torch.load(opt.src, map_location='cpu', weights_only=False)
+full = 'models' in sd and isinstance(sd['models'], dict)
+
+classifier = Classifier(opt.i)
+classifier.load_state_dict(sd['models']['classifier'] if full else sd)
+pooled = PooledClassifier(opt.i)
+pooled.init_from(classifier)
+
+if full:
+    sd['models']['classifier'] = pooled.state_dict()
+    # the optimizer state has the shapes of the old head, a resume starts it afresh
+    sd['optimizers'] = {}
+else:
+    sd = pooled.state_dict()
+atomic_save(sd, opt.dst)
+print('parameters: %d -> %d' % (sum(p.numel() for p in classifier.parameters()),
+                                sum(p.numel() for p in pooled.parameters())))
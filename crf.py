@@ -0,0 +1,126 @@
+import numpy as np
+import multiprocessing
+import cv2
+import pydensecrf.densecrf as dcrf
+from pydensecrf.utils import unary_from_softmax, create_pairwise_bilateral
+
+
+def dense_crf(img, probs, sdims=(80, 80), schan=(13, 13, 13), compat=1, n_iter=5):
+    """
+    fully connected CRF with a bilateral kernel on one image
+    img: H x W x C image
+    probs: nlabels x H x W softmax probabilities
+    returns the nlabels x H x W marginals after n_iter mean-field steps
+    """
+    d = dcrf.DenseCRF(img.shape[1] * img.shape[0], probs.shape[0])
+
+    # get unary potentials (neg log probability)
+    U = unary_from_softmax(probs)
+    d.setUnaryEnergy(U)
+
+    # This creates the color-dependent features and then add them to the CRF
+    feats = create_pairwise_bilateral(sdims=sdims, schan=schan, img=img, chdim=2)
+    d.addPairwiseEnergy(feats, compat=compat,
+                        kernel=dcrf.DIAG_KERNEL,
+                        normalization=dcrf.NORMALIZE_SYMMETRIC)
+
+    Q = d.inference(n_iter)
+    return np.array(Q).reshape((probs.shape[0], img.shape[0], img.shape[1]))
+
+
+def lowres_crf(img, probs, scale=0.5, sdims=(80, 80), schan=(13, 13, 13), compat=1, n_iter=5):
+    """
+    dense_crf on the image and probabilities downscaled by `scale` (the
+    spatial kernel is scaled along), marginals upsampled back bilinearly
+    """
+    h, w = img.shape[:2]
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    small = cv2.resize(img.astype(np.float32), size, interpolation=cv2.INTER_AREA)
+    sprobs = np.stack([cv2.resize(p.astype(np.float32), size, interpolation=cv2.INTER_AREA) for p in probs])
+    sprobs /= sprobs.sum(0, keepdims=True)
+    Q = dense_crf(small, sprobs, sdims=(sdims[0] * scale, sdims[1] * scale), schan=schan,
+                  compat=compat, n_iter=n_iter)
+    return np.stack([cv2.resize(q, (w, h), interpolation=cv2.INTER_LINEAR) for q in Q])
+
+
+def band_crf(img, probs, margin=0.3, radius=8, sdims=(80, 80), schan=(13, 13, 13), compat=1, n_iter=5):
+    """
+    dense_crf restricted to the uncertainty band around the predicted
+    boundary: pixels whose top probability is below 0.5 + margin, plus the
+    confident pixels within `radius` of them. those confident neighbours are
+    clamped to their label and only pass messages, every confident pixel
+    keeps its input probabilities
+    """
+    nlabels = probs.shape[0]
+    uncertain = probs.max(0) < 0.5 + margin
+    Q = np.array(probs, dtype=np.float32)
+    if not uncertain.any():
+        return Q
+    kernel = np.ones((2 * radius + 1, 2 * radius + 1), np.uint8)
+    band = np.flatnonzero(cv2.dilate(uncertain.astype(np.uint8), kernel))
+    p = Q.reshape(nlabels, -1)[:, band]
+    anchor = ~uncertain.ravel()[band]
+    p[:, anchor] = np.eye(nlabels, dtype=np.float32)[p[:, anchor].argmax(0)].T
+
+    d = dcrf.DenseCRF(len(band), nlabels)
+    d.setUnaryEnergy(unary_from_softmax(p))
+    feats = create_pairwise_bilateral(sdims=sdims, schan=schan, img=img, chdim=2)
+    d.addPairwiseEnergy(np.ascontiguousarray(feats[:, band]), compat=compat,
+                        kernel=dcrf.DIAG_KERNEL,
+                        normalization=dcrf.NORMALIZE_SYMMETRIC)
+    q = np.array(d.inference(n_iter))
+    Q = Q.reshape(nlabels, -1)
+    Q[:, band[~anchor]] = q[:, ~anchor]
+    return Q.reshape(probs.shape)
+
+
+# refinement modes selectable by name
+crf_modes = {'full': dense_crf, 'lowres': lowres_crf, 'band': band_crf}
+
+
+def _call(job):
+    fn, args, kwargs = job
+    return fn(*args, **kwargs)
+
+
+class CRFPool(object):
+    """
+    run DenseCRF jobs on a pool of worker processes.
+    jobs are handed out `chunksize` at a time and results are streamed back
+    in input order, so the caller can consume (or write) them while the
+    rest is still running.
+    processes: number of workers, default one per core, 0 runs the jobs in
+        the calling process
+    mode: 'full', 'lowres' or 'band' (see crf_modes), used by map()
+    crf_kwargs: sdims/schan/compat/n_iter (and scale or margin/radius) for map()
+    """
+    def __init__(self, processes=None, chunksize=1, mode='full', **crf_kwargs):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.chunksize = chunksize
+        self.crf = crf_modes[mode]
+        self.crf_kwargs = crf_kwargs
+        self.pool = None
+        if processes > 0:
+            # fork: the workers never touch CUDA, and the training scripts
+            # cannot be re-imported by spawn
+            self.pool = multiprocessing.get_context('fork').Pool(processes)
+
+    def imap(self, fn, jobs, **kwargs):
+        """
+        fn(*job, **kwargs) for every job (a tuple of arguments), in order
+        fn has to be a module level function
+        """
+        jobs = ((fn, job, kwargs) for job in jobs)
+        if self.pool is None:
+            return (_call(job) for job in jobs)
+        return self.pool.imap(_call, jobs, self.chunksize)
+
+    def map(self, imgs, probs):
+        return list(self.imap(self.crf, zip(imgs, probs), **self.crf_kwargs))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -11,3 +12,33 @@ class CrossEntropyLoss2d(nn.Module):
 
     def forward(self, outputs, targets):
         return self.loss(F.log_softmax(outputs), targets)
+
+
+class DownsampledCrossEntropyLoss2d(nn.Module):
+    """
+    CrossEntropyLoss2d of low-resolution logits upsampled (nearest) to the
+    size of the targets, computed at the resolution of the logits: every
+    logit cell is weighted by the label counts of the pixels it covers
+    (area-downsampled one-hot targets). same value and gradients, without
+    materializing the full-resolution logits
+    """
+    def __init__(self, weight=None):
+        super(DownsampledCrossEntropyLoss2d, self).__init__()
+        self.register_buffer('weight', weight)
+
+    def forward(self, outputs, targets):
+        L, h, w = outputs.shape[1:]
+        H, W = targets.shape[1:]
+        if H % h or W % w:
+            raise ValueError('targets %dx%d are not a multiple of outputs %dx%d' % (H, W, h, w))
+        with torch.no_grad():
+            counts = torch.stack([F.avg_pool2d((targets == k).float().unsqueeze(1), (H // h, W // w))[:, 0]
+                                  for k in range(L)], 1)
+            if self.weight is not None:
+                counts = counts * self.weight.view(1, L, 1, 1)
+        return -(counts * F.log_softmax(outputs, 1)).sum() / counts.sum()
+
+
+# segmentation losses selectable by name: 'full' takes logits upsampled to
+# the size of the targets, 'down' the logits of Deconv as they are
+seg_losses = {'full': CrossEntropyLoss2d, 'down': DownsampledCrossEntropyLoss2d}
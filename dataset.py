@@ -575,4 +575,19 @@ class MyTestData(data.Dataset):
         img /= self.std
         img = img.transpose(2, 0, 1)
         img = torch.from_numpy(img).float()
-        return img
\ No newline at end of file
+        return img
+
+class Indexed(data.Dataset):
+    """
+    wrap a dataset so that every sample comes with its index:
+    (index, img, gt, ...)
+    """
+    def __init__(self, dataset):
+        super(Indexed, self).__init__()
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return (index,) + tuple(self.dataset[index])
@@ -1,8 +1,10 @@
+import re
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.model_zoo as model_zoo
 from collections import OrderedDict
+from freeze import Freezable
 
 __all__ = ['DenseNet', 'densenet121', 'densenet169', 'densenet201', 'densenet161']
 
@@ -75,13 +77,13 @@ class _DenseLayer(nn.Sequential):
     def __init__(self, num_input_features, growth_rate, bn_size, drop_rate, dilation):
         super(_DenseLayer, self).__init__()
         pd = dilation
-        self.add_module('norm.1', nn.BatchNorm2d(num_input_features)),
-        self.add_module('relu.1', nn.ReLU(inplace=True)),
-        self.add_module('conv.1', nn.Conv2d(num_input_features, bn_size *
+        self.add_module('norm1', nn.BatchNorm2d(num_input_features)),
+        self.add_module('relu1', nn.ReLU(inplace=True)),
+        self.add_module('conv1', nn.Conv2d(num_input_features, bn_size *
                         growth_rate, kernel_size=1, stride=1, bias=False, dilation=dilation)),
-        self.add_module('norm.2', nn.BatchNorm2d(bn_size * growth_rate)),
-        self.add_module('relu.2', nn.ReLU(inplace=True)),
-        self.add_module('conv.2', nn.Conv2d(bn_size * growth_rate, growth_rate,
+        self.add_module('norm2', nn.BatchNorm2d(bn_size * growth_rate)),
+        self.add_module('relu2', nn.ReLU(inplace=True)),
+        self.add_module('conv2', nn.Conv2d(bn_size * growth_rate, growth_rate,
                         kernel_size=3, stride=1, padding=pd, bias=False, dilation=dilation)),
         self.drop_rate = drop_rate
 
@@ -111,7 +113,7 @@ class _Transition(nn.Sequential):
             self.add_module('pool', nn.AvgPool2d(kernel_size=2, stride=2))
 
 
-class DenseNet(nn.Module):
+class DenseNet(Freezable, nn.Module):
     r"""Densenet-BC model class, based on
     `"Densely Connected Convolutional Networks" <https://arxiv.org/pdf/1608.06993.pdf>`_
 
@@ -125,9 +127,11 @@ class DenseNet(nn.Module):
         num_classes (int) - number of classification classes
     """
     def __init__(self, growth_rate=32, block_config=(6, 12, 24, 16),
-                 num_init_features=64, bn_size=4, drop_rate=0, num_classes=1000):
+                 num_init_features=64, bn_size=4, drop_rate=0, num_classes=1000, output_stride=8):
 
         super(DenseNet, self).__init__()
+        assert output_stride in (8, 16, 32), 'output_stride 8, 16 or 32'
+        self.output_stride = output_stride
 
         # First convolution
         self.features = nn.Sequential(OrderedDict([
@@ -138,30 +142,23 @@ class DenseNet(nn.Module):
         ]))
 
         # Each denseblock
+        # the stem is at 1/4, the first transitions halve the resolution
+        # until output_stride, the blocks after the others are dilated instead
+        pools = {8: 1, 16: 2, 32: 3}[output_stride]
+        dilation = 1
         num_features = num_init_features
         for i, num_layers in enumerate(block_config):
-            if i == len(block_config)-1:
-                block = _DenseBlock(num_layers=num_layers, num_input_features=num_features,
-                                    bn_size=bn_size, growth_rate=growth_rate, drop_rate=drop_rate, dilation=4)
-            elif i == len(block_config)-2:
-                block = _DenseBlock(num_layers=num_layers, num_input_features=num_features,
-                                    bn_size=bn_size, growth_rate=growth_rate, drop_rate=drop_rate, dilation=2)
-            else:
-                block = _DenseBlock(num_layers=num_layers, num_input_features=num_features,
-                                    bn_size=bn_size, growth_rate=growth_rate, drop_rate=drop_rate, dilation=1)
+            block = _DenseBlock(num_layers=num_layers, num_input_features=num_features,
+                                bn_size=bn_size, growth_rate=growth_rate, drop_rate=drop_rate, dilation=dilation)
             self.features.add_module('denseblock%d' % (i + 1), block)
             num_features = num_features + num_layers * growth_rate
             if i != len(block_config) - 1:
-                if i == len(block_config)-2 or i == len(block_config)-3:
-                    trans = _Transition(num_input_features=num_features, num_output_features=num_features // 2,
-                                        before_dilation=True)
-                    self.features.add_module('transition%d' % (i + 1), trans)
-                    num_features = num_features // 2
-                else:
-                    trans = _Transition(num_input_features=num_features, num_output_features=num_features // 2,
-                                        before_dilation=False)
-                    self.features.add_module('transition%d' % (i + 1), trans)
-                    num_features = num_features // 2
+                trans = _Transition(num_input_features=num_features, num_output_features=num_features // 2,
+                                    before_dilation=i >= pools)
+                self.features.add_module('transition%d' % (i + 1), trans)
+                num_features = num_features // 2
+                if i >= pools:
+                    dilation *= 2
 
         # Final batch norm
         self.features.add_module('norm5', nn.BatchNorm2d(num_features))
@@ -179,8 +176,24 @@ class DenseNet(nn.Module):
             elif isinstance(m, nn.Linear):
                 m.bias.data.zero_()
 
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        # the layers used to be named 'norm.1', ... (the ImageNet weights and
+        # older checkpoints), torch no longer allows dots in module names
+        pattern = re.compile(r'^(.*denselayer\d+\.(?:norm|relu|conv))\.([12]\.(?:weight|bias|running_mean|running_var|num_batches_tracked))$')
+        state_dict = OrderedDict((pattern.sub(r'\1\2', k), v) for k, v in state_dict.items())
+        return super(DenseNet, self).load_state_dict(state_dict, *args, **kwargs)
+
+    def stages(self):
+        # stem + denseblock1 + transition1, ..., denseblock4 + norm5
+        stages = [[]]
+        for name, m in self.features.named_children():
+            if name.startswith('denseblock') and 'denseblock1' != name:
+                stages.append([])
+            stages[-1].append(m)
+        return stages
+
     def forward(self, x):
-        features = self.features(x)
+        features = self.run_stages(x)
         out = F.relu(features, inplace=True)
         out = F.max_pool2d(out, kernel_size=3, stride=1, padding=1, ceil_mode=True)
         return out
\ No newline at end of file
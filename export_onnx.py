@@ -0,0 +1,57 @@
+import time
+import torch
+from model import build_feature, Deconv
+from inference import prepare_inference, FullRes
+from prune import load_pruned
+from ort import OrtNet
+import argparse
+
+# one ONNX graph of the inference model: backbone + Deconv + softmax +
+# upsampling to the input size, any batch size and image size. the graph is
+# checked against PyTorch with ONNX Runtime at several input shapes
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32
+parser.add_argument('--seg_head', default='full')  # Deconv layers, see model.seg_head
+parser.add_argument('--ckpt', default='')  # full training checkpoint, used instead of --feat and --deconv
+parser.add_argument('--feat', default='')  # backbone weights
+parser.add_argument('--deconv', default='')  # Deconv weights
+parser.add_argument('--out', default='./model.onnx')  # the onnx file
+parser.add_argument('--opset', type=int, default=17)  # onnx opset version
+parser.add_argument('--no_fold', action='store_true')  # keep the BatchNorm layers instead of folding them into the convs
+parser.add_argument('--tol', type=float, default=1e-4)  # largest accepted difference of the probabilities
+parser.add_argument('--intra', type=int, default=0)  # onnxruntime threads within an operator, 0: default
+parser.add_argument('--inter', type=int, default=0)  # onnxruntime threads across operators, 0: default
+opt = parser.parse_args()
+print(opt)
+
+device = torch.device('cpu')
+feature = build_feature(opt.i, output_stride=opt.os)
+load_pruned(feature, opt.ckpt or opt.feat, 'feature', device)
+deconv = Deconv(opt.i, opt.seg_head, opt.os)
+load_pruned(deconv, opt.ckpt or opt.deconv, 'deconv', device)
+feature.eval()
+deconv.eval()
+net = FullRes(prepare_inference(feature, deconv, fold=not opt.no_fold))
+
+axes = {0: 'batch', 2: 'height', 3: 'width'}
+with torch.no_grad():
+    torch.onnx.export(net, torch.randn(1, 3, 256, 256), opt.out, input_names=['image'], output_names=['prob'],
+                      dynamic_axes={'image': axes, 'prob': axes}, opset_version=opt.opset)
+print('onnx model: %s' % opt.out)
+
+ort = OrtNet(opt.out, opt.intra, opt.inter)
+print('%-14s %10s %10s %10s' % ('input', 'torch ms', 'ort ms', 'max diff'))
+for b, h, w in [(1, 256, 256), (4, 256, 256), (2, 320, 224)]:
+    x = torch.randn(b, 3, h, w)
+    with torch.no_grad():
+        t = time.time()
+        ref = net(x)
+        t_ref = time.time() - t
+    t = time.time()
+    out = ort(x)
+    t_out = time.time() - t
+    err = (out - ref).abs().max().item()
+    print('%-14s %10.1f %10.1f %10.2e' % ('%dx3x%dx%d' % (b, h, w), 1000 * t_ref, 1000 * t_out, err))
+    assert out.shape == ref.shape and err <= opt.tol, 'outputs differ by %.2e' % err
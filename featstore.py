@@ -0,0 +1,90 @@
+import os
+import json
+import numpy as np
+import torch
+import torch.utils.data as data
+
+
+def build_feature_store(feature, dataset, root, device, copies=1, batch_size=16, num_workers=4, meta=None):
+    """
+    run the (frozen) backbone once over `dataset` and store its outputs in
+    root/feats.npy, a memory-mapped fp16 array, with the labels in
+    root/labels.npy
+    copies: number of passes over the dataset, each pass draws new random
+        augmentations if the dataset makes any
+    meta: dict saved along (root/meta.json), FeatureStore.matches() compares it
+    """
+    if not os.path.exists(root):
+        os.makedirs(root)
+    if os.path.exists(os.path.join(root, 'meta.json')):
+        # the store is invalid until it is complete
+        os.remove(os.path.join(root, 'meta.json'))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                         num_workers=num_workers, pin_memory=True)
+    feature.eval()
+    feats = labels = None
+    n = 0
+    with torch.no_grad():
+        for c in range(copies):
+            for ib, (img, lbl) in enumerate(loader):
+                out = feature(img.to(device)).half().cpu().numpy()
+                if feats is None:
+                    shape = (copies * len(dataset),) + out.shape[1:]
+                    # write to temp files and rename, a crash never leaves a torn store
+                    feats = np.lib.format.open_memmap(os.path.join(root, 'feats.npy.tmp'), mode='w+',
+                                                      dtype=np.float16, shape=shape)
+                    labels = np.zeros((shape[0],) + tuple(lbl.shape[1:]),
+                                      dtype=np.uint8 if lbl.dim() > 1 else np.int64)
+                feats[n:n + len(out)] = out
+                labels[n:n + len(out)] = lbl.numpy()
+                n += len(out)
+                print('features: %d/%d' % (n, len(labels)))
+    feats.flush()
+    del feats
+    with open(os.path.join(root, 'labels.npy.tmp'), 'wb') as f:
+        np.save(f, labels)
+    os.replace(os.path.join(root, 'labels.npy.tmp'), os.path.join(root, 'labels.npy'))
+    os.replace(os.path.join(root, 'feats.npy.tmp'), os.path.join(root, 'feats.npy'))
+    with open(os.path.join(root, 'meta.json'), 'w') as f:
+        json.dump(meta or {}, f)
+
+
+def file_key(filename):
+    # path, size and modification time of a weights file for the meta of a
+    # store: a file retrained in place no longer matches
+    if not filename:
+        return None
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_size, st.st_mtime_ns]
+
+
+class FeatureStore(data.Dataset):
+    """
+    backbone features written by build_feature_store, as a dataset of
+    (feats, gt) with feats a float tensor (C x h x w)
+    the features stay on disk (memory-mapped), the page cache keeps the
+    ones that fit in memory
+    """
+    def __init__(self, root):
+        super(FeatureStore, self).__init__()
+        self.root = root
+        self.labels = np.load(os.path.join(root, 'labels.npy'))
+        self.feats = None
+
+    @staticmethod
+    def matches(root, meta):
+        # True if root holds a complete store built with these settings
+        if not os.path.exists(os.path.join(root, 'feats.npy')) or not os.path.exists(os.path.join(root, 'meta.json')):
+            return False
+        with open(os.path.join(root, 'meta.json')) as f:
+            return json.load(f) == json.loads(json.dumps(meta))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        # opened on first use, so every loader worker maps the file itself
+        if self.feats is None:
+            self.feats = np.load(os.path.join(self.root, 'feats.npy'), mmap_mode='r')
+        feats = torch.from_numpy(self.feats[index].astype(np.float32))
+        return feats, torch.from_numpy(np.array(self.labels[index]))
@@ -0,0 +1,58 @@
+import torch
+
+
+class Freezable(object):
+    """
+    mixin for the backbones, which list their stages in stages() and run
+    them with run_stages(). a stage is a list of registered submodules run
+    in order (no new containers, so that FX can trace the backbones)
+    freeze(n) fixes the first n stages: their parameters stop requiring
+    gradients, they run under no_grad (none of their activations are kept
+    for backward) and their BatchNorm layers stay in eval mode
+    """
+    frozen = 0
+
+    def stages(self):
+        raise NotImplementedError
+
+    def freeze(self, n):
+        stages = self.stages()
+        assert 0 <= n <= len(stages), 'only %d stages' % len(stages)
+        self.frozen = n
+        for i, stage in enumerate(stages):
+            for m in stage:
+                for p in m.parameters():
+                    p.requires_grad = i >= n
+        return self.train(self.training)
+
+    def train(self, mode=True):
+        super(Freezable, self).train(mode)
+        for stage in self.stages()[:self.frozen]:
+            for m in stage:
+                m.eval()
+        return self
+
+    def run_stages(self, x):
+        stages = self.stages()
+        with torch.no_grad():
+            for stage in stages[:self.frozen]:
+                for m in stage:
+                    x = m(x)
+        for stage in stages[self.frozen:]:
+            for m in stage:
+                x = m(x)
+        return x
+
+
+def make_optimizer(groups):
+    """
+    a single Adam over the trainable parameters of several modules
+    groups: list of (module, lr), frozen parameters are left out
+    uses the fused implementation when every parameter is on a CUDA
+    device, the foreach one otherwise
+    """
+    groups = [{'params': [p for p in m.parameters() if p.requires_grad], 'lr': lr} for m, lr in groups]
+    groups = [g for g in groups if g['params']]
+    if all(p.is_cuda for g in groups for p in g['params']):
+        return torch.optim.Adam(groups, fused=True)
+    return torch.optim.Adam(groups, foreach=True)
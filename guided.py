@@ -0,0 +1,55 @@
+import torch
+import torch.nn.functional as F
+
+
+def box_filter(x, r):
+    """
+    mean of x (N x C x H x W) over (2r+1) x (2r+1) windows, clipped at the
+    borders, from the integral image: O(1) per pixel whatever the radius
+    """
+    H, W = x.shape[2:]
+    # accumulate in double, the integral image of a large image loses
+    # too many digits in float
+    c = F.pad(x.double().cumsum(2).cumsum(3), (1, 0, 1, 0))
+    ys = torch.arange(H, device=x.device)
+    xs = torch.arange(W, device=x.device)
+    y0, y1 = (ys - r).clamp(min=0), (ys + r + 1).clamp(max=H)
+    x0, x1 = (xs - r).clamp(min=0), (xs + r + 1).clamp(max=W)
+    top, bottom = c[:, :, y0], c[:, :, y1]
+    s = bottom[:, :, :, x1] - top[:, :, :, x1] - bottom[:, :, :, x0] + top[:, :, :, x0]
+    count = (y1 - y0).view(-1, 1) * (x1 - x0).view(1, -1)
+    return (s / count.double()).to(x.dtype)
+
+
+def guided_filter(guide, src, r=8, eps=0.1):
+    """
+    guided filter (He et al.) with a color guide, on a whole batch
+    guide: N x C x H x W images
+    src: N x 1 x H x W map to filter
+    eps: regularization, in the (squared) units of the guide
+    the output is locally a linear function of the guide, so it follows
+    the image edges inside every window
+    """
+    N, C, H, W = guide.shape
+    mean_I = box_filter(guide, r)
+    mean_p = box_filter(src, r)
+    cov_Ip = box_filter(guide * src, r) - mean_I * mean_p
+    II = (guide.unsqueeze(1) * guide.unsqueeze(2)).view(N, C * C, H, W)
+    var_I = box_filter(II, r).view(N, C, C, H, W) - mean_I.unsqueeze(1) * mean_I.unsqueeze(2)
+    var_I = var_I + eps * torch.eye(C, dtype=guide.dtype, device=guide.device).view(1, C, C, 1, 1)
+
+    # a = (var_I + eps)^-1 cov_Ip for every pixel
+    a = torch.linalg.solve(var_I.permute(0, 3, 4, 1, 2), cov_Ip.permute(0, 2, 3, 1).unsqueeze(-1))
+    a = a.squeeze(-1).permute(0, 3, 1, 2)
+    b = mean_p - (a * mean_I).sum(1, keepdim=True)
+    return (box_filter(a, r) * guide).sum(1, keepdim=True) + box_filter(b, r)
+
+
+def guided_refine(imgs, probs, r=8, eps=0.1):
+    """
+    edge-aware refinement of the hand probability: the foreground channel
+    of probs (N x 2 x H x W softmax) filtered with the images as guide
+    returns N x 2 x H x W probabilities
+    """
+    p = guided_filter(imgs, probs[:, 1:2], r, eps).clamp(0, 1)
+    return torch.cat((1 - p, p), 1)
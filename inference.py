@@ -0,0 +1,113 @@
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def fold_bn(conv, bn):
+    # conv followed by bn (running statistics) as one conv with bias
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight.data = (conv.weight * scale.view(-1, 1, 1, 1)).detach()
+    fused.bias.data = ((bias - bn.running_mean) * scale + bn.bias).detach()
+    return fused.to(conv.weight.device)
+
+
+class Affine(nn.Module):
+    """
+    BatchNorm2d with its running statistics, as a per-channel scale and
+    shift (for the ones that do not follow a conv, e.g. pre-activation)
+    """
+    def __init__(self, bn):
+        super(Affine, self).__init__()
+        scale = (bn.weight / torch.sqrt(bn.running_var + bn.eps)).detach()
+        self.register_buffer('scale', scale.view(1, -1, 1, 1))
+        self.register_buffer('shift', (bn.bias - bn.running_mean * scale).detach().view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return torch.addcmul(self.shift, x, self.scale)
+
+
+def fold_batchnorm(module):
+    """
+    fold in place every BatchNorm2d that directly follows a conv into it:
+    consecutive children of a Sequential (resnet downsample, densenet stem
+    and conv1/norm2) and the convN/bnN pairs of the resnet stem and
+    blocks. the remaining ones become Affine
+    """
+    for m in list(module.modules()):
+        for i in (1, 2, 3):
+            conv, bn = getattr(m, 'conv%d' % i, None), getattr(m, 'bn%d' % i, None)
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                setattr(m, 'conv%d' % i, fold_bn(conv, bn))
+                setattr(m, 'bn%d' % i, nn.Identity())
+        if isinstance(m, nn.Sequential):
+            names = list(m._modules)
+            for a, b in zip(names, names[1:]):
+                if isinstance(m._modules[a], nn.Conv2d) and isinstance(m._modules[b], nn.BatchNorm2d):
+                    m._modules[a] = fold_bn(m._modules[a], m._modules[b])
+                    m._modules[b] = nn.Identity()
+    for m in list(module.modules()):
+        for name, child in m._modules.items():
+            if isinstance(child, nn.BatchNorm2d):
+                m._modules[name] = Affine(child)
+    return module
+
+
+def drop_dropout(module):
+    # Dropout is the identity in eval mode, take it out of the graph
+    for m in list(module.modules()):
+        for name, child in m._modules.items():
+            if isinstance(child, nn.modules.dropout._DropoutNd):
+                m._modules[name] = nn.Identity()
+    return module
+
+
+class SegNet(nn.Module):
+    """
+    backbone + Deconv for inference only, returns the softmax of the logits
+    (N x 2 x h x w at 1/output_stride). build it with prepare_inference()
+    """
+    def __init__(self, feature, deconv):
+        super(SegNet, self).__init__()
+        self.feature = feature
+        self.deconv = deconv
+        self.output_stride = feature.output_stride
+        self.eval()
+
+    def train(self, mode=True):
+        if mode:
+            raise RuntimeError('SegNet is for inference only')
+        return super(SegNet, self).train(False)
+
+    def forward(self, x):
+        return F.softmax(self.deconv(self.feature(x)), dim=1)
+
+
+def prepare_inference(feature, deconv, fold=True):
+    """
+    copies of feature and deconv with the BatchNorm layers folded (fold)
+    and no Dropout, as a SegNet. the originals are left untouched
+    """
+    feature = copy.deepcopy(feature).eval()
+    deconv = copy.deepcopy(deconv).eval()
+    with torch.no_grad():
+        if fold:
+            fold_batchnorm(feature)
+            fold_batchnorm(deconv)
+        drop_dropout(deconv)
+    for p in list(feature.parameters()) + list(deconv.parameters()):
+        p.requires_grad = False
+    return SegNet(feature, deconv)
+
+
+class FullRes(nn.Module):
+    # the probabilities of a SegNet upsampled (bilinear) to the size of the input
+    def __init__(self, net):
+        super(FullRes, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        return F.interpolate(self.net(x), size=x.shape[2:], mode='bilinear', align_corners=False)
@@ -0,0 +1,159 @@
+import os
+import queue
+import threading
+import torch
+import torch.nn.functional as F
+import torchvision
+from myfunc import make_image_grid
+
+
+def _to_host(x):
+    # start copying x to the cpu without waiting for it, returns the copy
+    # and an event to wait on before reading it (None if x is on the cpu)
+    if not x.is_cuda:
+        return x.clone(), None
+    host = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+    host.copy_(x, non_blocking=True)
+    event = torch.cuda.Event()
+    event.record()
+    return host, event
+
+
+class MetricLogger(object):
+    """
+    training metrics and images without blocking the training loop
+    scalars given to add() are summed on their device; every `every`
+    steps the means are copied to the host in one asynchronous transfer
+    and handed to a background thread, which prints them and writes them
+    to the SummaryWriter and the CSV file. images given to image() are
+    snapshots copied the same way, the thread builds their grids
+    writer: SummaryWriter or None
+    csv: path of a CSV file (one row of means per flush) or None
+    mean, std: normalization of the input images, for 'image' snapshots
+    active: False on the ranks that do not log, every call is then a no-op
+    when the thread falls behind, snapshots are dropped instead of waiting
+    """
+    def __init__(self, writer=None, csv=None, every=20, mean=None, std=None, active=True, depth=16):
+        self.writer = writer
+        self.csv = csv
+        self.every = every
+        self.mean = mean
+        self.std = std
+        self.active = active
+        self.sums = {}
+        self.count = 0
+        self.dropped = 0
+        self.columns = None
+        self.queue = queue.Queue(depth)
+        self.thread = None
+        if active:
+            self.thread = threading.Thread(target=self._loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def due(self, step):
+        # True on the steps whose images are logged
+        return self.active and step % self.every == 0
+
+    def add(self, **scalars):
+        if not self.active:
+            return
+        for k, v in scalars.items():
+            if not torch.is_tensor(v):
+                v = torch.tensor(float(v))
+            v = v.detach().float()
+            if k in self.sums:
+                self.sums[k].add_(v)
+            else:
+                self.sums[k] = v.clone()
+        self.count += 1
+
+    def image(self, tag, x, step, kind='image'):
+        """
+        kind: 'image': normalized input images (N x 3 x H x W), 'prob':
+        logits whose softmax foreground (channel 1) is shown, 'mask': labels
+        (N x H x W)
+        """
+        if not self.active:
+            return
+        self._put(('image', tag, kind, step) + _to_host(x.detach()))
+
+    def scalars(self, step, **values):
+        # python numbers, written as they are (e.g. stats of other processes)
+        if self.active:
+            self._put(('scalars', step, values, None))
+
+    def step(self, step, **info):
+        # call at the end of every training step, info: e.g. epoch, printed along
+        if self.active and self.count and (step + 1) % self.every == 0:
+            self.flush(step, **info)
+
+    def flush(self, step, **info):
+        if not self.active or not self.count:
+            return
+        names = sorted(self.sums)
+        values = torch.stack([self.sums[k].to(self.sums[names[0]].device) for k in names]) / self.count
+        self.sums = {}
+        self.count = 0
+        self._put(('means', step, info, names) + _to_host(values))
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, event = item[0], item[-1]
+            if event is not None:
+                event.synchronize()
+            if 'means' == kind:
+                _, step, info, names, values, _ = item
+                self._write(step, info, dict(zip(names, values.tolist())))
+            elif 'scalars' == kind:
+                _, step, values, _ = item
+                if self.writer is not None:
+                    for k, v in values.items():
+                        self.writer.add_scalar(k, v, step)
+            else:
+                _, tag, how, step, x, _ = item
+                self._image(tag, how, x, step)
+
+    def _write(self, step, info, values):
+        print('%s (%s, step: %d)' % (', '.join('%s: %.4f' % kv for kv in sorted(values.items())),
+                                     ', '.join('%s: %s' % kv for kv in sorted(info.items())), step))
+        if self.writer is not None:
+            for k, v in values.items():
+                self.writer.add_scalar(k, v, step)
+        if self.csv is not None:
+            if self.columns is None:
+                self.columns = sorted(values)
+                if not os.path.exists(self.csv):
+                    with open(self.csv, 'w') as f:
+                        f.write(','.join(['step'] + sorted(info) + self.columns) + '\n')
+            with open(self.csv, 'a') as f:
+                f.write(','.join([str(step)] + [str(info[k]) for k in sorted(info)] +
+                                 ['%g' % values.get(k, float('nan')) for k in self.columns]) + '\n')
+
+    def _image(self, tag, kind, x, step):
+        if self.writer is None:
+            return
+        if 'image' == kind:
+            grid = make_image_grid(x[:, :3], self.mean, self.std)
+        else:
+            if 'prob' == kind:
+                x = F.softmax(x.float(), 1)[:, 1:2]
+            else:
+                x = x.float().unsqueeze(1)
+            grid = torchvision.utils.make_grid(x.repeat(1, 3, 1, 1))
+        self.writer.add_image(tag, grid, step)
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,104 @@
+import torch.nn as nn
+import torch.utils.model_zoo as model_zoo
+from freeze import Freezable
+
+
+__all__ = ['MobileNetV2', 'mobilenet_v2']
+
+
+model_urls = {
+    'mobilenet_v2': 'https://download.pytorch.org/models/mobilenet_v2-b0353104.pth',
+}
+
+
+class ConvBNReLU(nn.Sequential):
+    def __init__(self, in_planes, out_planes, kernel_size=3, stride=1, groups=1, dilation=1):
+        padding = (kernel_size - 1) // 2 * dilation
+        super(ConvBNReLU, self).__init__(
+            nn.Conv2d(in_planes, out_planes, kernel_size, stride, padding, dilation=dilation,
+                      groups=groups, bias=False),
+            nn.BatchNorm2d(out_planes),
+            nn.ReLU6(inplace=True)
+        )
+
+
+class InvertedResidual(nn.Module):
+    def __init__(self, inp, oup, stride, expand_ratio, dilation=1):
+        super(InvertedResidual, self).__init__()
+        hidden_dim = int(round(inp * expand_ratio))
+        self.use_res_connect = stride == 1 and inp == oup
+
+        layers = []
+        if expand_ratio != 1:
+            # pw
+            layers.append(ConvBNReLU(inp, hidden_dim, kernel_size=1))
+        layers.extend([
+            # dw
+            ConvBNReLU(hidden_dim, hidden_dim, stride=stride, groups=hidden_dim, dilation=dilation),
+            # pw-linear
+            nn.Conv2d(hidden_dim, oup, 1, 1, 0, bias=False),
+            nn.BatchNorm2d(oup),
+        ])
+        self.conv = nn.Sequential(*layers)
+
+    def forward(self, x):
+        if self.use_res_connect:
+            return x + self.conv(x)
+        return self.conv(x)
+
+
+class MobileNetV2(Freezable, nn.Module):
+    """
+    MobileNetV2 features (the layer names of torchvision, without the last
+    1x1 conv and the classifier), 320 channels at 1/output_stride: the
+    strides past output_stride are replaced by dilation
+    """
+    # t, c, n, s
+    settings = [[1, 16, 1, 1], [6, 24, 2, 2], [6, 32, 3, 2], [6, 64, 4, 2],
+                [6, 96, 3, 1], [6, 160, 3, 2], [6, 320, 1, 1]]
+    # end of the 1/4, 1/8, 1/16 and 1/32 parts of self.features
+    stage_ends = (4, 7, 14, 18)
+
+    def __init__(self, output_stride=8):
+        super(MobileNetV2, self).__init__()
+        assert output_stride in (8, 16, 32), 'output_stride 8, 16 or 32'
+        self.output_stride = output_stride
+        features = [ConvBNReLU(3, 32, stride=2)]
+        input_channel = 32
+        stride, dilation = 2, 1
+        for t, c, n, s in self.settings:
+            if s > 1 and stride * s > output_stride:
+                s, dilation = 1, dilation * 2
+            else:
+                stride *= s
+            for i in range(n):
+                features.append(InvertedResidual(input_channel, c, s if i == 0 else 1, t, dilation))
+                input_channel = c
+        self.features = nn.Sequential(*features)
+
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d):
+                nn.init.kaiming_normal_(m.weight, mode='fan_out')
+            elif isinstance(m, nn.BatchNorm2d):
+                nn.init.ones_(m.weight)
+                nn.init.zeros_(m.bias)
+
+    def stages(self):
+        return [list(self.features[b:e]) for b, e in zip((0,) + self.stage_ends[:-1], self.stage_ends)]
+
+    def forward(self, x):
+        return self.run_stages(x)
+
+
+def mobilenet_v2(pretrained=False, **kwargs):
+    """Constructs a MobileNetV2 backbone.
+
+    Args:
+        pretrained (bool): If True, returns a model pre-trained on ImageNet
+    """
+    model = MobileNetV2(**kwargs)
+    if pretrained:
+        state_dict = model_zoo.load_url(model_urls['mobilenet_v2'])
+        own = model.state_dict()
+        model.load_state_dict(dict((k, v) for k, v in state_dict.items() if k in own))
+    return model
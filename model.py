@@ -4,39 +4,162 @@ import torch.nn.functional as F
 import torchvision
 from torch.nn import init
 import pdb
+from functools import partial
+from vgg import Vgg16
+from resnet import resnet18, resnet34, resnet50
+from densenet import densenet121
+from mobilenet import mobilenet_v2
 
 
 def nothing(x):
     return x
 
 
+# backbone name (--i) -> constructor, channels of its output
+backbones = {'vgg': Vgg16, 'resnet': resnet50, 'densenet': densenet121,
+             'resnet18': resnet18, 'resnet34': resnet34, 'mobilenet': mobilenet_v2}
+feature_channels = {'vgg': 512, 'resnet': 2048, 'densenet': 1024,
+                    'resnet18': 512, 'resnet34': 512, 'mobilenet': 320}
+
+
+def build_feature(iii, pretrained=False, output_stride=8):
+    # backbone named iii (see backbones), output_stride 8, 16 or 32
+    if iii not in backbones:
+        raise ValueError('unknown backbone %s' % iii)
+    return backbones[iii](pretrained=pretrained, output_stride=output_stride)
+
+
+def reduce_channel(iii):
+    # 1x1 conv bringing the backbone features to the 512 channels of vgg
+    if 512 != feature_channels[iii]:
+        return nn.Conv2d(feature_channels[iii], 512, kernel_size=1)
+    return nothing
+
+
+def _split_bn_forward(bn, sizes, x):
+    return torch.cat([type(bn).forward(bn, c) for c in x.split(sizes)], 0)
+
+
+class split_batchnorm(object):
+    """
+    while active, every BatchNorm layer of `module` in training mode
+    normalizes each chunk of the batch (given by `sizes`) with its own
+    statistics, and updates its running stats once per chunk in order,
+    exactly as if the chunks had been forwarded one after another
+    """
+    def __init__(self, module, sizes):
+        self.bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        self.sizes = list(sizes)
+
+    def __enter__(self):
+        for m in self.bns:
+            if m.training:
+                m.forward = partial(_split_bn_forward, m, self.sizes)
+        return self
+
+    def __exit__(self, *args):
+        for m in self.bns:
+            m.__dict__.pop('forward', None)
+
+
+def fused_forward(module, inputs, split_bn=True):
+    """
+    run several batches through `module` as one concatenated batch and split
+    the output back per batch.
+    split_bn: keep per-batch BatchNorm statistics (same result as separate
+    forwards), otherwise they are computed over the concatenated batch
+    """
+    sizes = [x.size(0) for x in inputs]
+    x = torch.cat(inputs, 0)
+    if split_bn:
+        with split_batchnorm(module, sizes):
+            out = module(x)
+    else:
+        out = module(x)
+    return out.split(sizes)
+
+
+def sep_conv(cin, cout, dilation):
+    # depthwise 3x3 (dilated) conv followed by a pointwise 1x1 conv
+    return nn.Sequential(
+        nn.Conv2d(cin, cin, kernel_size=3, stride=1, padding=dilation, dilation=dilation, groups=cin),
+        nn.Conv2d(cin, cout, kernel_size=1)
+    )
+
+
+class ASPPLite(nn.Module):
+    """
+    small atrous spatial pyramid pooling: a 1x1 conv, separable 3x3 convs at
+    several dilations and the image mean, each to `width` channels, fused
+    by a 1x1 conv. no BatchNorm, like the other Deconv heads
+    """
+    def __init__(self, cin, width=128, dilations=(6, 12, 18)):
+        super(ASPPLite, self).__init__()
+        self.branches = nn.ModuleList([nn.Conv2d(cin, width, kernel_size=1)] +
+                                      [sep_conv(cin, width, d) for d in dilations])
+        self.image = nn.Conv2d(cin, width, kernel_size=1)
+        self.fuse = nn.Conv2d(width * (len(dilations) + 2), width, kernel_size=1)
+
+    def forward(self, x):
+        image = F.relu(self.image(F.adaptive_avg_pool2d(x, 1)))
+        y = [F.relu(b(x)) for b in self.branches] + [image.expand(-1, -1, x.size(2), x.size(3))]
+        return self.fuse(torch.cat(y, 1))
+
+
+def seg_head(head, output_stride=8):
+    """
+    the layers of Deconv after reduce_channel, on 512 channels
+    the dilations are given for output stride 8 and scaled down for 16, 32
+    'full': the original fc6 (3x3 dilation 12, 1024 channels) and fc7
+    'sep': fc6 as a depthwise separable conv, 512 channels
+    'slim': the original layers at 256 channels
+    'aspp': ASPPLite at 128 channels
+    """
+    def dil(d):
+        return max(1, d * 8 // output_stride)
+    if 'aspp' == head:
+        return nn.Sequential(ASPPLite(512, 128, [dil(d) for d in (6, 12, 18)]), nn.ReLU(), nn.Dropout(), nn.Conv2d(128, 2, kernel_size=1))
+    if 'sep' == head:
+        fc6, width = sep_conv(512, 512, dil(12)), 512
+    elif 'slim' == head:
+        fc6, width = nn.Conv2d(512, 256, kernel_size=3, stride=1, padding=dil(12), dilation=dil(12)), 256
+    else:
+        assert 'full' == head, 'unknown head %s' % head
+        fc6, width = nn.Conv2d(512, 1024, kernel_size=3, stride=1, padding=dil(12), dilation=dil(12)), 1024
+    return nn.Sequential(
+        # fc6
+        fc6,
+        nn.ReLU(),
+        nn.Dropout(),
+        # fc7
+        nn.Conv2d(width, width, kernel_size=1),
+        nn.ReLU(),
+        nn.Dropout(),
+        # fc8
+        nn.Conv2d(width, 2, kernel_size=1)
+    )
+
+
 class Deconv(nn.Module):
-    def __init__(self, iii):
+    """
+    segmentation head on the backbone features (1/output_stride resolution),
+    head: one of the layer stacks of seg_head()
+    """
+    def __init__(self, iii, head='full', output_stride=8):
         super(Deconv, self).__init__()
-        if 'resnet' == iii:
-            self.reduce_channel = nn.Conv2d(2048, 512, kernel_size=1)
-        elif 'densenet' == iii:
-            self.reduce_channel = nn.Conv2d(1024, 512, kernel_size=1)
-        else:
-            self.reduce_channel = nothing
-        self.main = nn.Sequential(
-            # fc6
-            nn.Conv2d(512, 1024, kernel_size=3, stride=1, padding=12, dilation=12),
-            nn.ReLU(),
-            nn.Dropout(),
-            # fc7
-            nn.Conv2d(1024, 1024, kernel_size=1),
-            nn.ReLU(),
-            nn.Dropout(),
-            # fc8
-            nn.Conv2d(1024, 2, kernel_size=1)
-        )
+        self.reduce_channel = reduce_channel(iii)
+        self.main = seg_head(head, output_stride)
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
-                m.weight.data.normal_(0, 0.01)
+                if 'full' == head or m.out_channels == 2:
+                    m.weight.data.normal_(0, 0.01)
+                else:
+                    # depthwise and narrow layers would start with a vanishing signal
+                    init.kaiming_normal_(m.weight.data, nonlinearity='relu')
+                    m.bias.data.zero_()
 
     def load_state_dict(self, sd):
-        sb = sd.items()
+        sb = list(sd.items())
         if 'main.1.weight' == sb[0][0]:
             self.main[0].weight.data = sb[0][1]
             self.main[0].bias.data = sb[1][1]
@@ -54,17 +177,15 @@ class Deconv(nn.Module):
 
 
 class Classifier(nn.Module):
-    def __init__(self, iii):
+    def __init__(self, iii, output_stride=8):
         super(Classifier, self).__init__()
-        if 'resnet' == iii:
-            self.reduce_channel = nn.Conv2d(2048, 512, kernel_size=1)
-        elif 'densenet' == iii:
-            self.reduce_channel = nn.Conv2d(1024, 512, kernel_size=1)
-        else:
-            self.reduce_channel = nothing
+        # max pooling down to 1/16 (256x256 inputs: a 16x16 map, 8x8 at stride 32)
+        self.pool = max(16 // output_stride, 1)
+        size = 256 // (output_stride * self.pool)
+        self.reduce_channel = reduce_channel(iii)
         self.main = nn.Sequential(
             # fc6
-            nn.Linear(16*16*512, 1024),
+            nn.Linear(size*size*512, 1024),
             # fc7
             nn.Linear(1024, 1024),
             # fc8
@@ -76,8 +197,71 @@ class Classifier(nn.Module):
                 m.bias.data.fill_(0)
 
     def forward(self, x):
-        x = F.max_pool2d(x, 2, 2, ceil_mode=True)
+        if self.pool > 1:
+            x = F.max_pool2d(x, self.pool, self.pool, ceil_mode=True)
         x = self.reduce_channel(x)
         bsize = x.size(0)
         x = self.main(x.view(bsize, -1))
-        return x
\ No newline at end of file
+        return x
+
+class PooledClassifier(nn.Module):
+    """
+    Classifier for any input size: the features are average pooled to a
+    pyramid of l x l grids (l in levels), whose cells feed a small MLP
+    """
+    def __init__(self, iii, levels=(1, 2, 4), hidden=256, output_stride=8):
+        super(PooledClassifier, self).__init__()
+        self.levels = tuple(levels)
+        self.pool = max(16 // output_stride, 1)
+        self.reduce_channel = reduce_channel(iii)
+        self.main = nn.Sequential(
+            # fc6
+            nn.Linear(512 * sum(l * l for l in self.levels), hidden),
+            nn.ReLU(),
+            nn.Dropout(),
+            # fc7
+            nn.Linear(hidden, 2)
+        )
+        for m in self.modules():
+            if isinstance(m, nn.Linear):
+                m.weight.data.normal_(0, 0.01)
+                m.bias.data.fill_(0)
+
+    def init_from(self, classifier):
+        """
+        initialize from a trained Classifier. its three linear layers
+        collapse into one affine map z, whose weights are summed over the
+        cells of each bin of the finest level; the MLP computes
+        relu(z) - relu(-z) in its first 4 hidden units, the others start
+        with no effect on the output. the result is the output of
+        classifier when its (reduced) input is constant within every bin
+        """
+        fc6, fc7, fc8 = classifier.main
+        size = int(round((fc6.in_features / 512) ** 0.5))
+        l = self.levels[-1]
+        assert 0 == size % l, 'the finest level (%d) has to divide %d' % (l, size)
+        with torch.no_grad():
+            w = fc8.weight.mm(fc7.weight).mm(fc6.weight)
+            b = fc8.weight.mv(fc7.weight.mv(fc6.bias) + fc7.bias) + fc8.bias
+            w = w.view(2, 512, l, size // l, l, size // l).sum(5).sum(3).view(2, -1)
+            first, last = self.main[0], self.main[3]
+            first.weight[:4] = 0
+            first.weight[:2, -w.size(1):] = w
+            first.weight[2:4, -w.size(1):] = -w
+            first.bias[:4] = torch.cat([b, -b])
+            last.weight.zero_()
+            last.weight[0, 0], last.weight[0, 2] = 1, -1
+            last.weight[1, 1], last.weight[1, 3] = 1, -1
+            last.bias.zero_()
+            if isinstance(classifier.reduce_channel, nn.Module):
+                self.reduce_channel.load_state_dict(classifier.reduce_channel.state_dict())
+
+    def forward(self, x):
+        if self.pool > 1:
+            x = F.max_pool2d(x, self.pool, self.pool, ceil_mode=True)
+        # the 1x1 conv commutes with average pooling, it runs on the pooled cells
+        x = torch.cat([self.reduce_channel(F.adaptive_avg_pool2d(x, l)).flatten(1) for l in self.levels], 1)
+        return self.main(x)
+
+
+classifiers = {'linear': Classifier, 'pooled': PooledClassifier}
@@ -3,8 +3,9 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torchvision.utils import make_grid
-import pydensecrf.densecrf as dcrf
-from pydensecrf.utils import unary_from_softmax, create_pairwise_bilateral
+from crf import dense_crf
+from convcrf import conv_crf
+from guided import guided_refine
 import pdb
 import random
 from torch.autograd.variable import Variable
@@ -20,71 +21,78 @@ def make_image_grid(img, mean, std):
     return img
 
 
-def crf_func(imgs, plabels):
-    outputs = []
-    for img, probs in zip(imgs, plabels):
-        # Example using the DenseCRF class and the util functions
-        d = dcrf.DenseCRF(img.shape[1] * img.shape[0], 2)
-
-        # get unary potentials (neg log probability)
-        U = unary_from_softmax(probs)
-        d.setUnaryEnergy(U)
-
-        # This creates the color-dependent features and then add them to the CRF
-        feats = create_pairwise_bilateral(sdims=(80, 80), schan=(13, 13, 13),
-                                          img=img, chdim=2)
-        d.addPairwiseEnergy(feats, compat=1,
-                            kernel=dcrf.DIAG_KERNEL,
-                            normalization=dcrf.NORMALIZE_SYMMETRIC)
+def iou(pred, gt):
+    # intersection over union of two binary hand masks
+    pred = np.asarray(pred) > 0
+    gt = np.asarray(gt) > 0
+    union = np.logical_or(pred, gt).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(pred, gt).sum()) / union
 
-        # Run five inference steps.
-        Q = d.inference(5)
 
-        # Find out the most probable class for each pixel.
-        # MAP = np.argmax(Q, axis=0)
-        # bb = 1-MAP.reshape(img.shape[:2])
-        bb = np.array(Q).reshape((2, img.shape[0], img.shape[1]))
-        outputs.append(bb)
+def crf_func(imgs, plabels, pool=None):
+    # compat=1 on the (normalized) network inputs, images run in parallel
+    # when a crf.CRFPool is given
+    if pool is not None:
+        return np.array(pool.map(imgs, plabels))
+    outputs = []
+    for img, probs in zip(imgs, plabels):
+        outputs.append(dense_crf(img, probs, sdims=(80, 80), schan=(13, 13, 13), compat=1, n_iter=5))
     outputs = np.array(outputs)
     return outputs
 
 
-def avg_func(feature, deconv, imgs, num=8):
+def refine_func(method, imgs, probs, pool=None):
+    """
+    refine a batch of softmax probabilities (N x 2 x H x W tensor) with the
+    input images (N x 3 x H x W tensor on the same device)
+    method: 'dense': pydensecrf on the cpu (crf_func), 'conv': convcrf on
+    the device, 'guided': guided filter on the device, 'none'
+    """
+    if 'dense' == method:
+        outputs = crf_func(imgs.cpu().numpy().transpose(0, 2, 3, 1), probs.cpu().numpy(), pool)
+        return torch.from_numpy(outputs).float().to(probs.device)
+    if 'conv' == method:
+        return conv_crf(imgs, probs, sdims=(80, 80), schan=(13, 13, 13), compat=1, n_iter=5)
+    if 'guided' == method:
+        return guided_refine(imgs, probs, r=8, eps=0.1)
+    return probs
+
+
+def avg_func(feature, deconv, imgs, num=8, seed=None, chunk=None):
+    """
+    hand probability averaged over `num` random crops (90% of the size) of
+    the images and `num` of their horizontal flips.
+    crops are stacked and forwarded `chunk` crops (x batch size) at a time,
+    `num` by default; flips are done on the device. every pixel gets the mean
+    over the crops covering it (0 if none does)
+    seed: fixed crop positions, for reproducible pseudo labels
+    """
+    stride = feature.output_stride
     imgH = imgs.size(2)
     imgW = imgs.size(3)
-    avg_msk = torch.zeros(imgs.size(0), imgH, imgW).cuda()
     H = int(0.9 * imgH)
-    H -= H%8
+    H -= H%stride
     W = int(0.9 * imgW)
-    W -= W%8
-    for n in range(num):
-        H_offset = random.choice(range(imgH - H))
-        W_offset = random.choice(range(imgW - W))
-        # H_slice = slice(H_offset, H_offset + H)
-        # W_slice = slice(W_offset, W_offset + W)
-        _imgs = imgs[:, :, H_offset:H_offset+H, W_offset:W_offset+W]
-        feat = feature(_imgs)
-        msk = deconv(feat)
-        msk = F.upsample(msk, scale_factor=8)
-        msk = F.softmax(msk).data[:, 1]
-        avg_msk[:, H_offset:H_offset+H, W_offset:W_offset+W] = avg_msk[:, H_offset:H_offset+H, W_offset:W_offset+W] * n / (n+1) + msk / (n+1)
-    sb = imgs.data.cpu().numpy()
-    sb = sb[:, :, :, ::-1]
-    _imgs = Variable(torch.from_numpy(sb.copy()).cuda())
-    avg_msk2 = torch.zeros(imgs.size(0), imgH, imgW).cuda()
-    for n in range(num):
-        H_offset = random.choice(range(imgH - H))
-        W_offset = random.choice(range(imgW - W))
-        # H_slice = slice(H_offset, H_offset + H)
-        # W_slice = slice(W_offset, W_offset + W)
-        __imgs = _imgs[:, :, H_offset:H_offset + H, W_offset:W_offset + W]
-        feat = feature(__imgs)
-        msk = deconv(feat)
-        msk = F.upsample(msk, scale_factor=8)
-        msk = F.softmax(msk).data[:, 1]
-        avg_msk2[:, H_offset:H_offset + H, W_offset:W_offset + W] = avg_msk2[:, H_offset:H_offset + H,
-                                                                   W_offset:W_offset + W] * n / (n + 1) + msk / (n + 1)
-    sb = avg_msk2.cpu().numpy()
-    sb = sb[:, :, ::-1]
-    avg_msk2 = torch.from_numpy(sb.copy()).cuda()
-    return (avg_msk+avg_msk2)/2
+    W -= W%stride
+    rng = random.Random(seed) if seed is not None else random
+    offsets = [(rng.choice(range(imgH - H)), rng.choice(range(imgW - W))) for n in range(2*num)]
+    chunk = chunk or num
+    with torch.no_grad():
+        imgs = torch.stack((imgs, imgs.flip(3)))
+        crops = torch.cat([imgs[n // num, :, :, h:h+H, w:w+W] for n, (h, w) in enumerate(offsets)])
+        msk = []
+        for c in crops.split(chunk * imgs.size(1)):
+            m = deconv(feature(c))
+            # nearest upsampling commutes with the softmax
+            m = F.softmax(m, dim=1)[:, 1:2]
+            msk.append(F.upsample(m, scale_factor=stride)[:, 0])
+        msk = torch.cat(msk).view(2*num, imgs.size(1), H, W)
+        acc = imgs.new_zeros(2, imgs.size(1), imgH, imgW)
+        cnt = imgs.new_zeros(2, 1, imgH, imgW)
+        for n, (h, w) in enumerate(offsets):
+            acc[n // num, :, h:h+H, w:w+W] += msk[n]
+            cnt[n // num, :, h:h+H, w:w+W] += 1
+        avg_msk = acc / cnt.clamp(min=1)
+    return (avg_msk[0] + avg_msk[1].flip(2))/2
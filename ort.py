@@ -0,0 +1,25 @@
+import torch
+import onnxruntime
+
+# ONNX Runtime (cpu) inference of the graphs written by export_onnx.py
+
+
+class OrtNet(object):
+    """
+    an onnx model as a callable on image tensors, returning the class
+    probabilities as a tensor. intra / inter: threads within one operator /
+    across operators, 0: the onnxruntime default
+    """
+    def __init__(self, filename, intra=0, inter=0):
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra
+        options.inter_op_num_threads = inter
+        if inter > 1:
+            # inter-op threads are only used by the parallel executor
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+        self.session = onnxruntime.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        out = self.session.run(None, {self.input: x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(out)
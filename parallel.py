@@ -0,0 +1,171 @@
+import os
+import math
+import datetime
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Sampler
+
+
+def init_distributed(backend='gloo', timeout=30):
+    """
+    join the process group set up by the launcher (torchrun sets RANK,
+    WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT)
+    timeout: minutes a collective may wait for the other ranks
+    returns rank, world_size
+    """
+    dist.init_process_group(backend=backend, init_method='env://', timeout=datetime.timedelta(minutes=timeout))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_gather_object(obj):
+    # list of `obj` from every rank, in rank order
+    if not is_distributed():
+        return [obj]
+    out = [None] * get_world_size()
+    dist.all_gather_object(out, obj)
+    return out
+
+
+def get_device(cpu=False):
+    if cpu or not torch.cuda.is_available():
+        return torch.device('cpu')
+    if is_distributed():
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        torch.cuda.set_device(local_rank)
+        return torch.device('cuda', local_rank)
+    return torch.device('cuda')
+
+
+def broadcast_object(obj):
+    # rank 0's `obj` on every rank
+    if not is_distributed():
+        return obj
+    out = [obj]
+    dist.broadcast_object_list(out, src=0)
+    return out[0]
+
+
+class ResumableSampler(Sampler):
+    """
+    this rank's 1/world_size shard of the dataset, shuffled with a
+    permutation that only depends on seed and epoch (padded to the same
+    length on every rank, like DistributedSampler)
+    `start` skips the first samples of the next pass, so an epoch can be
+    continued after the batches already trained (see restore_loader).
+    len() is always the length of a whole epoch
+    """
+    def __init__(self, dataset, shuffle=True, seed=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.num_samples = int(math.ceil(len(dataset) / float(self.world_size)))
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        n = len(self.dataset)
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=g).tolist()
+        else:
+            indices = list(range(n))
+        total = self.num_samples * self.world_size
+        indices += indices[:total - n]
+        indices = indices[self.rank:total:self.world_size]
+        # the offset only applies to the pass right after a restore
+        start, self.start = self.start, 0
+        return iter(indices[start:])
+
+    def __len__(self):
+        return self.num_samples
+
+
+def make_loader(dataset, batch_size, shuffle=True, num_workers=4, pin_memory=True):
+    # every rank gets its own 1/world_size shard of the dataset per epoch,
+    # batch_size is per process
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, sampler=ResumableSampler(dataset, shuffle),
+        num_workers=num_workers, pin_memory=pin_memory)
+
+
+def set_epoch(loader, epoch):
+    # reshuffle, otherwise every epoch sees the same order
+    if isinstance(loader.sampler, ResumableSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def loader_state(loader, batches):
+    # position of a make_loader loader after `batches` batches of its current epoch
+    return {'epoch': loader.sampler.epoch, 'offset': batches * loader.batch_size}
+
+
+def restore_loader(loader, state):
+    """
+    make the next pass over `loader` continue at the position saved by
+    loader_state (a state without offset stands for a finished epoch)
+    returns the epoch and the index of the next batch, the next epoch
+    and 0 when the saved one was finished
+    """
+    epoch = state['epoch']
+    batches = state['offset'] // loader.batch_size if 'offset' in state else len(loader)
+    if batches >= len(loader):
+        epoch, batches = epoch + 1, 0
+    loader.sampler.set_epoch(epoch)
+    loader.sampler.start = batches * loader.batch_size
+    return epoch, batches
+
+
+def wrap(module, device):
+    if not is_distributed():
+        return module
+    device_ids = [device.index] if 'cuda' == device.type else None
+    return DistributedDataParallel(module, device_ids=device_ids)
+
+
+def unwrap(module):
+    if isinstance(module, DistributedDataParallel):
+        return module.module
+    return module
+
+
+class Step(nn.Module):
+    """
+    run a whole training forward (e.g. backbone on the cls batch and on the
+    seg batch) as a single module call.
+    DDP all-reduces gradients once per forward/backward pair, so a backbone
+    shared by several losses has to be called inside one wrapped forward.
+    fn: callable doing the forward on the modules passed as keywords
+    """
+    def __init__(self, fn, **modules):
+        super(Step, self).__init__()
+        for name, m in modules.items():
+            self.add_module(name, m)
+        self.fn = fn
+
+    def forward(self, *inputs):
+        return self.fn(*inputs)
+
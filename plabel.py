@@ -0,0 +1,287 @@
+import os
+import time
+import queue
+import atexit
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from myfunc import avg_func, refine_func
+from crf import CRFPool
+
+
+def make_pseudo_labels(feature, deconv, data, device, num=8, seed=None, pool=None, crf='dense'):
+    """
+    pseudo labels for images without pixel annotations: prediction averaged
+    over random crops and flips (avg_func), refined by a CRF and
+    thresholded at 0.5
+    num, seed: number of crops (per flip) and crop seed of avg_func
+    crf: refinement, 'dense' (pydensecrf), 'conv' (batched convcrf on `device`)
+        or 'guided' (guided filter on `device`)
+    pool: crf.CRFPool to run the dense CRF of the images in parallel
+    data: cpu tensor of normalized images, n x 3 x H x W
+    returns uint8 array of 0/1 masks, n x H x W
+    """
+    data = data.to(device)
+    with torch.no_grad():
+        probs = avg_func(feature, deconv, data, num, seed)
+        probs = refine_func(crf, data, torch.stack((1 - probs, probs), 1), pool)
+    return (probs[:, 1] >= 0.5).cpu().numpy().astype(np.uint8)
+
+
+class PseudoLabelStore(object):
+    """
+    bit-packed binary pseudo labels keyed by sample index
+    names: the dataset's image names, used to match entries when loading
+        a store saved for another listing of the same data
+    size: (H, W) of the masks
+    every: labels are reused for this many epochs before being regenerated
+    a label also becomes stale when bump() is called after it was made
+    (e.g. whenever the weights are checkpointed)
+    """
+    def __init__(self, names, size=(256, 256), every=1):
+        self.names = list(names)
+        self.size = tuple(size)
+        self.every = every
+        self.version = 0
+        num = len(self.names)
+        self.bits = np.zeros((num, (self.size[0] * self.size[1] + 7) // 8), dtype=np.uint8)
+        self.made_epoch = np.full(num, -1, dtype=np.int64)
+        self.made_version = np.full(num, -1, dtype=np.int64)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return int((self.made_epoch >= 0).sum())
+
+    def bump(self):
+        self.version += 1
+
+    def stale(self, indices, epoch):
+        # boolean array, True where the label has to be (re)generated
+        indices = np.asarray(indices)
+        made = self.made_epoch[indices]
+        stale = (made < 0) | (epoch - made >= self.every) | (self.made_version[indices] != self.version)
+        self.misses += int(stale.sum())
+        self.hits += int((~stale).sum())
+        return stale
+
+    def put(self, indices, masks, epoch, version=None):
+        # version: store version of the weights that made the masks, default the current one
+        indices = np.asarray(indices)
+        masks = np.asarray(masks, dtype=np.uint8).reshape(len(indices), -1)
+        self.bits[indices] = np.packbits(masks, axis=1)
+        self.made_epoch[indices] = epoch
+        self.made_version[indices] = self.version if version is None else version
+
+    def get(self, indices):
+        indices = np.asarray(indices)
+        masks = np.unpackbits(self.bits[indices], axis=1)[:, :self.size[0] * self.size[1]]
+        return masks.reshape((len(indices),) + self.size)
+
+    def save(self, path):
+        # write to a temp file and rename, so a crash never leaves a torn store
+        tmp = '%s.tmp' % path
+        with open(tmp, 'wb') as f:
+            np.savez(f, names=np.array(self.names), size=np.array(self.size), bits=self.bits,
+                     made_epoch=self.made_epoch, made_version=self.made_version,
+                     version=np.array(self.version))
+        os.replace(tmp, path)
+
+    def load(self, path):
+        sd = np.load(path)
+        if tuple(sd['size']) != self.size:
+            return 0
+        pos = dict((name, i) for i, name in enumerate(self.names))
+        src, dst = [], []
+        for i, name in enumerate(sd['names']):
+            if name in pos:
+                src.append(i)
+                dst.append(pos[name])
+        self.bits[dst] = sd['bits'][src]
+        self.made_epoch[dst] = sd['made_epoch'][src]
+        self.made_version[dst] = sd['made_version'][src]
+        self.version = int(sd['version'])
+        return len(dst)
+
+
+def _teacher_loop(build, device, num, seed, threads, crf_workers, crf_mode, crf, jobs, results, weights):
+    if threads > 0:
+        torch.set_num_threads(threads)
+    pool = CRFPool(crf_workers, mode=crf_mode) if 'dense' == crf else None
+    feature, deconv = build()
+    feature.to(device)
+    deconv.to(device)
+    version, label_version = -1, -1
+    while True:
+        # always label with the newest snapshot, wait for the first one
+        try:
+            while True:
+                version, label_version, sd_feature, sd_deconv = weights.get(version < 0)
+                feature.load_state_dict(sd_feature)
+                deconv.load_state_dict(sd_deconv)
+        except queue.Empty:
+            pass
+        job = jobs.get()
+        if job is None:
+            break
+        indices, data = job
+        results.put((indices, make_pseudo_labels(feature, deconv, data, device, num, seed, pool, crf),
+                     version, label_version))
+    if pool is not None:
+        pool.close()
+
+
+class PseudoLabelTeacher(object):
+    """
+    generate pseudo labels in a separate process, from a snapshot of
+    feature/deconv that the trainer refreshes every `sync_every` steps
+    the process is forked, so create the teacher before this process
+    initializes CUDA or runs any torch op, the child can then use its own
+    device. it waits for a first sync() before labelling anything
+    build: function returning new (feature, deconv) modules on the cpu
+    depth: maximum number of batches being labelled ahead of training
+    crf_workers, crf_mode: CRF process pool of the teacher (0: serial) and its mode
+    crf: 'dense', 'conv' or 'guided', see make_pseudo_labels
+    the process is not daemonic (it may start the CRF pool), close() ends
+    it, and is also called at exit
+    """
+    def __init__(self, build, device='cpu', depth=4, sync_every=100, num=8, seed=None, threads=0,
+                 crf_workers=0, crf_mode='full', crf='dense'):
+        ctx = mp.get_context('fork')
+        self.depth = depth
+        self.sync_every = sync_every
+        self.jobs = ctx.Queue(depth)
+        self.results = ctx.Queue(depth)
+        self.weights = ctx.Queue(1)
+        self.proc = ctx.Process(target=_teacher_loop, args=(
+            build, device, num, seed, threads, crf_workers, crf_mode, crf, self.jobs, self.results, self.weights))
+        self.proc.start()
+        atexit.register(self.close)
+        self.steps = 0
+        self.version = -1
+        self.label_version = 0
+        # sample indices submitted and not collected yet, across epochs
+        self.pending = set()
+        self.in_flight = 0
+        self.wait_time = 0.0
+        # seconds between checks that the teacher is alive, while waiting on it
+        self.timeout = 5.0
+
+    def sync(self, feature, deconv, version, label_version=None):
+        # label_version: PseudoLabelStore version of these weights, kept until changed
+        if label_version is not None:
+            self.label_version = label_version
+        snapshot = (version, self.label_version,
+                    dict((k, v.detach().cpu().clone()) for k, v in feature.state_dict().items()),
+                    dict((k, v.detach().cpu().clone()) for k, v in deconv.state_dict().items()))
+        # replace a snapshot the teacher has not picked up yet
+        try:
+            self.weights.get_nowait()
+        except queue.Empty:
+            pass
+        self.weights.put(snapshot)
+        self.version = version
+
+    def step(self, feature, deconv):
+        # call once per training step, after the optimizer step
+        self.steps += 1
+        if self.steps % self.sync_every == 0:
+            self.sync(feature, deconv, self.steps)
+
+    def submit(self, indices, data):
+        while True:
+            try:
+                self.jobs.put((indices, data), True, self.timeout)
+                break
+            except queue.Full:
+                self.check()
+        self.in_flight += 1
+        self.pending.update(indices.tolist())
+
+    def collect(self, block=False):
+        out = []
+        t = time.time()
+        while self.in_flight > 0:
+            try:
+                out.append(self.results.get(block and not out, self.timeout))
+            except queue.Empty:
+                if block and not out:
+                    self.check()
+                    continue
+                break
+            self.in_flight -= 1
+            self.pending.difference_update(out[-1][0].tolist())
+        if block:
+            self.wait_time += time.time() - t
+        return out
+
+    def stats(self):
+        return {'synced_step': self.version, 'steps': self.steps, 'in_flight': self.in_flight,
+                'jobs_queued': self.jobs.qsize(), 'results_queued': self.results.qsize(),
+                'wait_time': self.wait_time}
+
+    def check(self):
+        # called while waiting on the teacher, so that a dead one fails training instead of hanging it
+        if not self.proc.is_alive():
+            raise RuntimeError('pseudo label teacher exited with code %s' % self.proc.exitcode)
+
+    def close(self):
+        if self.proc.is_alive():
+            try:
+                self.jobs.put(None, True, 1)
+            except queue.Full:
+                pass
+            self.proc.join(10)
+        if self.proc.is_alive():
+            self.proc.terminate()
+            self.proc.join()
+
+
+def async_pseudo_labels(loader, teacher, store, epoch):
+    """
+    iterate over `loader` (yielding index, img, gt with gt=2 for images that
+    need pseudo labels) with `teacher.depth` batches of look-ahead: the stale
+    positives of upcoming batches are sent to the teacher, and every batch
+    comes out with gt filled from `store`.
+    training only waits for labels that were never generated before, an
+    older label is used while its refresh is still in flight (refreshes
+    still in flight at the end of the epoch are collected in the next one).
+    labels made with weights from before the last store.bump() are kept
+    with their version, so they stay stale and are made again
+    """
+    pending = teacher.pending
+    window = []
+
+    def receive(block):
+        for indices, masks, version, label_version in teacher.collect(block):
+            store.put(indices, masks, epoch, label_version)
+
+    def enqueue(batch):
+        idx, data, lbl = batch
+        sb = (lbl[:, 0, 0] == 2).nonzero().view(-1)
+        if len(sb):
+            sb_idx = idx[sb].numpy()
+            todo = store.stale(sb_idx, epoch) & np.array([i not in pending for i in sb_idx.tolist()], dtype=bool)
+            if todo.any():
+                sel = torch.from_numpy(todo.nonzero()[0])
+                teacher.submit(sb_idx[todo], data[sb[sel]].clone())
+        window.append((idx, data, lbl, sb))
+
+    it = iter(loader)
+    for batch in it:
+        enqueue(batch)
+        if len(window) >= teacher.depth:
+            break
+    while window:
+        receive(False)
+        idx, data, lbl, sb = window.pop(0)
+        lbl = lbl.long()
+        if len(sb):
+            sb_idx = idx[sb].numpy()
+            while (store.made_epoch[sb_idx] < 0).any():
+                receive(True)
+            lbl[sb, :, :] = torch.from_numpy(store.get(sb_idx)).long()
+        batch = next(it, None)
+        if batch is not None:
+            enqueue(batch)
+        yield idx, data, lbl
@@ -0,0 +1,135 @@
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as functional
+from myfunc import iou
+
+# structured (channel) pruning of the VGG conv4/conv5 layers, reduce_channel
+# and the Deconv fc6/fc7 layers: channels are ranked by their first order
+# Taylor saliency on a calibration set and removed, giving smaller dense convs
+
+
+def prune_units(feature, deconv):
+    """
+    (producer, consumer) conv pairs whose channels can be removed together:
+    the output channels of the producer are the input channels of the
+    consumer. the output of the backbone keeps its width, so that every
+    head still fits
+    """
+    units = []
+    if hasattr(feature, 'main'):
+        convs = [m for m in feature.main if isinstance(m, nn.Conv2d)]
+        # conv4_1 ... conv5_2, each feeding the next conv
+        units += list(zip(convs[7:12], convs[8:13]))
+    main = deconv.main
+    # fc6, relu, dropout, fc7, relu, dropout, fc8; the aspp head has no fc7
+    assert 7 == len(main) and isinstance(main[3], nn.Conv2d), 'only the full, slim and sep heads can be pruned'
+    fc6 = main[0][-1] if isinstance(main[0], nn.Sequential) else main[0]
+    if isinstance(deconv.reduce_channel, nn.Conv2d) and isinstance(main[0], nn.Conv2d):
+        units.append((deconv.reduce_channel, main[0]))
+    units += [(fc6, main[3]), (main[3], main[6])]
+    return units
+
+
+def taylor_saliency(feature, deconv, loader, units, criterion, device, batches):
+    """
+    |a * dL/da| of the output channels of every producer, summed over the
+    positions, averaged over the calibration batches and normalized per
+    layer. zero where the ReLU that follows is inactive, like the product
+    after it
+    """
+    scores = [0 for u in units]
+    acts = {}
+
+    def keep(m, inputs, out):
+        out.retain_grad()
+        acts[m] = out
+    handles = [p.register_forward_hook(keep) for p, c in units]
+    feature.eval()
+    deconv.eval()
+    for ib, (data, lbl) in enumerate(loader):
+        if ib == batches:
+            break
+        msk = deconv(feature(data.to(device)))
+        msk = functional.upsample(msk, scale_factor=feature.output_stride)
+        feature.zero_grad()
+        deconv.zero_grad()
+        criterion(msk, lbl.long().to(device)).backward()
+        for i, (p, c) in enumerate(units):
+            a = acts[p]
+            scores[i] = scores[i] + (a * a.grad).sum((2, 3)).abs().mean(0).detach()
+    for h in handles:
+        h.remove()
+    return [s / s.norm() for s in scores]
+
+
+def prune_unit(producer, consumer, keep):
+    # keep: indices of the output channels of producer to keep
+    producer.weight = nn.Parameter(producer.weight.data[keep].clone())
+    if producer.bias is not None:
+        producer.bias = nn.Parameter(producer.bias.data[keep].clone())
+    producer.out_channels = len(keep)
+    consumer.weight = nn.Parameter(consumer.weight.data[:, keep].clone())
+    consumer.in_channels = len(keep)
+
+
+def prune(feature, deconv, scores, sparsity):
+    """
+    copies of feature and deconv with the least salient `sparsity` fraction
+    of the channels of every unit removed
+    """
+    feature, deconv = copy.deepcopy(feature), copy.deepcopy(deconv)
+    for (p, c), s in zip(prune_units(feature, deconv), scores):
+        n = max(1, int(round(len(s) * (1 - sparsity))))
+        keep = s.argsort(descending=True)[:n].sort()[0]
+        prune_unit(p, c, keep)
+    return feature, deconv
+
+
+def resize_convs(module, sd):
+    # give the convs of module the shapes of the (pruned) state dict sd
+    for name, m in module.named_modules():
+        if isinstance(m, nn.Conv2d) and name + '.weight' in sd and sd[name + '.weight'].shape != m.weight.shape:
+            w = sd[name + '.weight']
+            m.weight = nn.Parameter(m.weight.data.new_empty(w.shape))
+            if m.bias is not None:
+                m.bias = nn.Parameter(m.bias.data.new_empty(w.shape[0]))
+            m.out_channels, m.in_channels = w.shape[0], w.shape[1] * m.groups
+
+
+def load_pruned(module, filename, key, map_location=None):
+    """
+    load_weights for files that may hold a pruned model: the convs of
+    module are resized to the saved shapes first
+    """
+    sd = torch.load(filename, map_location=map_location, weights_only=False)
+    if 'models' in sd and isinstance(sd['models'], dict):
+        sd = sd['models'][key]
+    resize_convs(module, sd)
+    module.load_state_dict(sd)
+
+
+def evaluate(feature, deconv, loader, device, batches):
+    # ms per batch of feature + deconv and the IoU of the hand masks
+    ious = []
+    t = 0.0
+    n = 0
+    with torch.no_grad():
+        for img, gt in loader:
+            if n == batches:
+                break
+            n += 1
+            img = img.to(device)
+            if 'cuda' == device.type:
+                torch.cuda.synchronize()
+            start = time.time()
+            msk = deconv(feature(img))
+            if 'cuda' == device.type:
+                torch.cuda.synchronize()
+            t += time.time() - start
+            msk = functional.interpolate(msk, size=gt.shape[1:], mode='bilinear', align_corners=False)
+            ious += [iou(p, g) for p, g in zip(msk.argmax(1).cpu().numpy(), gt.numpy())]
+    return 1000 * t / n, np.mean(ious)
+
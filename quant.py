@@ -0,0 +1,96 @@
+import copy
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import get_default_qconfig_mapping, get_default_qat_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, prepare_qat_fx, convert_fx
+
+# int8 versions of feature + Deconv (FX graph mode): quantization aware
+# training, post-training calibration, conversion to a TorchScript int8 model
+# for the cpu. densenet is left out: its pre-activation BatchNorm layers
+# cannot be fused into the convs
+
+
+class SegModel(nn.Module):
+    # feature + deconv as one module returning the logits, the unit that gets quantized
+    def __init__(self, feature, deconv):
+        super(SegModel, self).__init__()
+        self.feature = feature
+        self.deconv = deconv
+
+    def forward(self, x):
+        return self.deconv(self.feature(x))
+
+
+class Int8Net(nn.Module):
+    # an int8 model of load_int8 returning the softmax of the logits, like inference.SegNet
+    def __init__(self, model):
+        super(Int8Net, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return F.softmax(self.model(x), dim=1)
+
+
+def example_input(size=256):
+    return (torch.randn(1, 3, size, size),)
+
+
+def prepare_qat(feature, deconv, backend='x86'):
+    """
+    SegModel of (copies of) feature and deconv with conv+bn+relu fused and
+    fake quantization inserted, to be fine-tuned in training mode
+    """
+    torch.backends.quantized.engine = backend
+    model = SegModel(copy.deepcopy(feature), copy.deepcopy(deconv)).train()
+    return prepare_qat_fx(model, get_default_qat_qconfig_mapping(backend), example_input())
+
+
+def prepare_ptq(feature, deconv, backend='x86'):
+    """
+    SegModel of (copies of) feature and deconv with conv+bn(+relu) fused
+    and observers inserted, to be calibrated in eval mode with calibrate()
+    """
+    torch.backends.quantized.engine = backend
+    model = SegModel(copy.deepcopy(feature), copy.deepcopy(deconv)).eval()
+    return prepare_fx(model, get_default_qconfig_mapping(backend), example_input())
+
+
+def calibrate(prepared, batches):
+    # run the batches (image tensors) through the observers
+    prepared.eval()
+    with torch.no_grad():
+        for x in batches:
+            prepared(x)
+    return prepared
+
+
+def convert_int8(prepared):
+    """
+    int8 TorchScript model (cpu) from a calibrated or QAT-trained model,
+    returns float logits like SegModel
+    """
+    model = copy.deepcopy(prepared).cpu().eval()
+    model.apply(torch.ao.quantization.disable_observer)
+    model = convert_fx(model)
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(model, example_input()))
+
+
+def save_int8(model, filename):
+    # the file only needs torch to load (load_int8), not this repository
+    tmp = '%s.tmp' % filename
+    torch.jit.save(model, tmp)
+    os.replace(tmp, filename)
+
+
+def load_int8(filename, backend='x86'):
+    torch.backends.quantized.engine = backend
+    return torch.jit.load(filename, map_location='cpu')
+
+
+def freeze_qat(prepared):
+    # keep the quantization ranges and the BatchNorm statistics fixed for the rest of the fine-tuning
+    prepared.apply(torch.ao.quantization.disable_observer)
+    prepared.apply(torch.ao.nn.intrinsic.qat.freeze_bn_stats)
@@ -1,6 +1,7 @@
 import torch.nn as nn
 import math
 import torch.utils.model_zoo as model_zoo
+from freeze import Freezable
 
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
@@ -16,21 +17,21 @@ model_urls = {
 }
 
 
-def conv3x3(in_planes, out_planes, stride=1):
+def conv3x3(in_planes, out_planes, stride=1, dilation=1):
     "3x3 convolution with padding"
     return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride,
-                     padding=1, bias=False)
+                     padding=dilation, bias=False, dilation=dilation)
 
 
 class BasicBlock(nn.Module):
     expansion = 1
 
-    def __init__(self, inplanes, planes, stride=1, downsample=None):
+    def __init__(self, inplanes, planes, stride=1, downsample=None, dilation=1):
         super(BasicBlock, self).__init__()
-        self.conv1 = conv3x3(inplanes, planes, stride)
+        self.conv1 = conv3x3(inplanes, planes, stride, dilation)
         self.bn1 = nn.BatchNorm2d(planes)
         self.relu = nn.ReLU(inplace=True)
-        self.conv2 = conv3x3(planes, planes)
+        self.conv2 = conv3x3(planes, planes, dilation=dilation)
         self.bn2 = nn.BatchNorm2d(planes)
         self.downsample = downsample
         self.stride = stride
@@ -94,20 +95,30 @@ class Bottleneck(nn.Module):
         return out
 
 
-class ResNet(nn.Module):
+class ResNet(Freezable, nn.Module):
 
-    def __init__(self, block, layers, num_classes=1000):
+    def __init__(self, block, layers, num_classes=1000, output_stride=8):
+        assert output_stride in (8, 16, 32), 'output_stride 8, 16 or 32'
         self.inplanes = 64
         super(ResNet, self).__init__()
+        self.output_stride = output_stride
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
                                bias=False)
         self.bn1 = nn.BatchNorm2d(64)
         self.relu = nn.ReLU(inplace=True)
-        self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
+        # stride 8 keeps the stem at 1/2 and dilates layer4, 16 restores the
+        # stem pooling, 32 also the stride of layer4
+        if 8 == output_stride:
+            self.stem_pool = nn.MaxPool2d(kernel_size=3, stride=1, padding=1, ceil_mode=True)
+        else:
+            self.stem_pool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
         self.layer1 = self._make_layer(block, 64, layers[0])
         self.layer2 = self._make_layer(block, 128, layers[1], stride=2)
         self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
-        self.layer4 = self._make_layer(block, 512, layers[3], stride=1, dilation=2)
+        if output_stride < 32:
+            self.layer4 = self._make_layer(block, 512, layers[3], stride=1, dilation=2)
+        else:
+            self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=1, padding=1, ceil_mode=True)
         self.fc = nn.Linear(512 * block.expansion, num_classes)
 
@@ -136,19 +147,13 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def stages(self):
+        # stem + layer1, layer2, layer3, layer4
+        return [[self.conv1, self.bn1, self.relu, self.stem_pool, self.layer1],
+                [self.layer2], [self.layer3], [self.layer4, self.maxpool]]
+
     def forward(self, x):
-        x = self.conv1(x)
-        x = self.bn1(x)
-        x = self.relu(x)
-        x = self.maxpool(x)
-
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
-
-        x = self.maxpool(x)
-        return x
+        return self.run_stages(x)
 
 
 def resnet18(pretrained=False, **kwargs):
@@ -6,26 +6,38 @@ import torchvision
 from dataset import MyTestData
 import cv2
 from criterion import CrossEntropyLoss2d
-from model import Deconv
-from vgg import Vgg16
-from resnet import resnet50
-from densenet import densenet121
+from model import build_feature, Deconv
 from PIL import Image
-from tensorboard import SummaryWriter
 from datetime import datetime
 import os
 import pdb
-from myfunc import make_image_grid, avg_func, crf_func
+from myfunc import make_image_grid, avg_func, crf_func, refine_func
+import parallel
+from prune import load_pruned
+from inference import prepare_inference
+import quant
 import numpy as np
 import argparse
 
 parser = argparse.ArgumentParser()
 
-parser.add_argument('--i', default='vgg')  # dataset
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--seg_head', default='full')  # Deconv layers: 'full', 'sep' (separable fc6), 'slim' (256 channels) or 'aspp' (ASPP-lite)
 parser.add_argument('--test_dir', default='/home/zeng/data/datasets/oxhand/test')  # dataset
 parser.add_argument('--output_dir', default='/home/zeng/data/datasets/oxhand/test/seg_alt_msk')
 parser.add_argument('--feat', default='/home/zeng/handseg/parameters_alt_msk/feature-epoch-19-step-356.pth')
 parser.add_argument('--deconv', default='/home/zeng/handseg/parameters_alt_msk/deconv-epoch-19-step-356.pth')
+parser.add_argument('--ckpt', default='')  # full training checkpoint, used instead of --feat and --deconv
+parser.add_argument('--crf', default='none')  # refinement: 'none', 'dense' (pydensecrf), 'conv' (batched convcrf) or 'guided' (guided filter)
+parser.add_argument('--b', type=int, default=1)  # batch size
+parser.add_argument('--cpu', action='store_true')  # run on the cpu even if cuda is available
+parser.add_argument('--no_fold', action='store_true')  # keep the BatchNorm layers instead of folding them into the convs
+parser.add_argument('--int8', default='')  # int8 model of calibrate.py or train.py --qat, used instead of the float weights (cpu only)
+parser.add_argument('--backend', default='x86')  # quantized engine of --int8: 'x86' or 'fbgemm'
+parser.add_argument('--onnx', default='')  # onnx model of export_onnx.py, run with onnxruntime on the cpu instead of PyTorch
+parser.add_argument('--intra', type=int, default=0)  # with --onnx, threads within an operator, 0: onnxruntime default
+parser.add_argument('--inter', type=int, default=0)  # with --onnx, threads across operators, 0: onnxruntime default
 opt = parser.parse_args()
 print(opt)
 
@@ -38,45 +50,50 @@ if not os.path.exists(output_dir):
     os.mkdir(output_dir)
 
 # models
-if 'vgg' == opt.i:
-    feature = Vgg16()
-elif 'resnet' == opt.i:
-    feature = resnet50()
-elif 'densenet' == opt.i:
-    feature = densenet121()
-feature.cuda()
-feature.load_state_dict(torch.load(feature_param_file))
+if opt.int8:
+    device = torch.device('cpu')
+    net = quant.Int8Net(quant.load_int8(opt.int8, opt.backend))
+elif opt.onnx:
+    # onnxruntime is only needed here
+    from ort import OrtNet
+    device = torch.device('cpu')
+    net = OrtNet(opt.onnx, opt.intra, opt.inter)
+else:
+    feature = build_feature(opt.i, pretrained=False, output_stride=opt.os)
+    device = parallel.get_device(opt.cpu)
+    feature.to(device)
+    load_pruned(feature, opt.ckpt or feature_param_file, 'feature', device)
+    feature.eval()
 
-deconv = Deconv(opt.i)
-deconv.cuda()
-deconv.load_state_dict(torch.load(deconv_param_file))
+    deconv = Deconv(opt.i, opt.seg_head, opt.os)
+    deconv.to(device)
+    load_pruned(deconv, opt.ckpt or deconv_param_file, 'deconv', device)
+    deconv.eval()
+    net = prepare_inference(feature, deconv, fold=not opt.no_fold)
 
 loader = torch.utils.data.DataLoader(
     MyTestData(test_dir, transform=True),
-    batch_size=1, shuffle=True, num_workers=4, pin_memory=True)
+    batch_size=opt.b, shuffle=True, num_workers=4, pin_memory=True)
 
 it = 1
 for ib, (data, img_name, img_size) in enumerate(loader):
-    print img_name
-    it +=1
-    inputs = Variable(data).cuda()
+    print(img_name)
+    it += 1
+    inputs = data.to(device)
 
-    feats = feature(inputs)
+    with torch.no_grad():
+        msk = net(inputs)
 
-    msk = deconv(feats)
-    # _, msk = msk.max(1)
-    # msk = msk.data[0].cpu().numpy()
-    msk = functional.softmax(msk)
+        # msk = avg_func(feature, deconv, inputs, 8)
+        # msk = torch.stack((1-msk, msk), 1)
 
-    msk = msk.data[0, 1].cpu().numpy()
+        if 'none' != opt.crf:
+            # refine the whole batch at the input resolution
+            msk = functional.interpolate(msk, size=inputs.shape[2:], mode='bilinear', align_corners=False)
+            msk = refine_func(opt.crf, inputs, msk)
 
-    # msk = avg_func(feature, deconv, inputs, 8)
-    # msk = msk.cpu().numpy()
-    # msk = crf_func(data.cpu().numpy().transpose(0, 2, 3, 1), np.stack((1-msk, msk), 1))
-    # msk = msk[0, 1]
-
-    msk = (msk*255).astype(np.uint8)
-    msk = Image.fromarray(msk)
-
-    msk = msk.resize((img_size[0][0], img_size[1][0]))
-    msk.save('%s/%s.png'%(output_dir, img_name[0]), 'PNG')
\ No newline at end of file
+    msk = msk[:, 1].cpu().numpy()
+    for i in range(msk.shape[0]):
+        m = Image.fromarray((msk[i]*255).astype(np.uint8))
+        m = m.resize((int(img_size[0][i]), int(img_size[1][i])))
+        m.save('%s/%s.png'%(output_dir, img_name[i]), 'PNG')
@@ -6,25 +6,25 @@ import torchvision
 from dataset import MyClsTestData
 import cv2
 from criterion import CrossEntropyLoss2d
-from model import Classifier
-from vgg import Vgg16
-from resnet import resnet50
-from densenet import densenet121
+from model import build_feature, classifiers
 from PIL import Image
-from tensorboard import SummaryWriter
 from datetime import datetime
 import os
 import pdb
 from myfunc import make_image_grid, avg_func, crf_func
 import numpy as np
+from checkpoint import load_weights
 import argparse
 
 parser = argparse.ArgumentParser()
 
-parser.add_argument('--i', default='vgg')  # dataset
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--cls_head', default='linear')  # classifier head: 'linear' (fixed 256x256 input) or 'pooled' (pyramid pooling, any input size)
 parser.add_argument('--test_dir', default='/home/zeng/data/datasets/clshand/val')  # dataset
 parser.add_argument('--feat', default='/home/zeng/handseg/parameters_cls/feature-epoch-19-step-365.pth')
 parser.add_argument('--cls', default='/home/zeng/handseg/parameters_cls/classifier-epoch-19-step-365.pth')
+parser.add_argument('--ckpt', default='')  # full training checkpoint, used instead of --feat and --cls
 parser.add_argument('--b', type=int, default=16)  # batch size
 opt = parser.parse_args()
 print(opt)
@@ -35,18 +35,13 @@ class_param_file = opt.cls
 bsize = opt.b
 
 # models
-if 'vgg' == opt.i:
-    feature = Vgg16()
-elif 'resnet' == opt.i:
-    feature = resnet50()
-elif 'densenet' == opt.i:
-    feature = densenet121()
+feature = build_feature(opt.i, pretrained=False, output_stride=opt.os)
 feature.cuda()
-feature.load_state_dict(torch.load(feature_param_file))
+load_weights(feature, opt.ckpt or feature_param_file, 'feature')
 
-classifier = Classifier(opt.i)
+classifier = classifiers[opt.cls_head](opt.i, output_stride=opt.os)
 classifier.cuda()
-classifier.load_state_dict(torch.load(class_param_file))
+load_weights(classifier, opt.ckpt or class_param_file, 'classifier')
 
 loader = torch.utils.data.DataLoader(
     MyClsTestData(test_dir, transform=True),
@@ -62,4 +57,4 @@ for ib, (data, lbl) in enumerate(loader):
     output = classifier(feats)
     _, pred_lbl = torch.max(output, 1)
     num_correct += (pred_lbl.data==lbl).sum()
-print num_correct / it
\ No newline at end of file
+print(float(num_correct) / it)
\ No newline at end of file
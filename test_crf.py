@@ -3,48 +3,57 @@ import cv2
 import os
 import numpy as np
 import matplotlib.pyplot as plt
-import pydensecrf.densecrf as dcrf
-from pydensecrf.utils import unary_from_softmax, create_pairwise_bilateral
-
-
-img_root = '/home/zeng/data/datasets/oxhand/val/images'
-map_root = '/home/zeng/data/datasets/oxhand/val/seg'
-output_root = '/home/zeng/data/datasets/oxhand/val/seg_crf'
-
-files = os.listdir(img_root)
-it = 1
-for img_name in files:
-    if not img_name.endswith('.jpg'):
-        continue
-    pass
-    print it
-    it += 1
+from crf import CRFPool, crf_modes
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--img_root', default='/home/zeng/data/datasets/oxhand/val/images')
+parser.add_argument('--map_root', default='/home/zeng/data/datasets/oxhand/val/seg')
+parser.add_argument('--output_root', default='/home/zeng/data/datasets/oxhand/val/seg_crf')
+parser.add_argument('--workers', type=int, default=0)  # crf processes, 0: one per core
+parser.add_argument('--chunk', type=int, default=4)  # images handed to a worker at a time
+parser.add_argument('--mode', default='full')  # 'full', 'lowres' or 'band'
+parser.add_argument('--scale', type=float, default=0.5)  # resolution of the 'lowres' crf
+parser.add_argument('--margin', type=float, default=0.3)  # 'band': pixels with top probability below 0.5+margin are refined
+parser.add_argument('--radius', type=int, default=8)  # 'band': confident neighbours within radius pass messages
+opt = parser.parse_args()
+print(opt)
+
+img_root = opt.img_root
+map_root = opt.map_root
+output_root = opt.output_root
+
+
+def refine(img_name):
+    # read, refine and write one image, runs in the worker processes so that
+    # file io overlaps with the crf of the other images
     img = cv2.imread(os.path.join(img_root, img_name))
     probs = cv2.imread(os.path.join(map_root, img_name[:-4] + '.png'), 0).astype('float')
     probs /= 255
     probs = np.stack((probs, 1-probs), 0)
 
-    # Example using the DenseCRF class and the util functions
-    d = dcrf.DenseCRF(img.shape[1] * img.shape[0], 2)
-
-    # get unary potentials (neg log probability)
-    U = unary_from_softmax(probs)
-    d.setUnaryEnergy(U)
-
-    # This creates the color-dependent features and then add them to the CRF
-    feats = create_pairwise_bilateral(sdims=(80, 80), schan=(13, 13, 13),
-                                      img=img, chdim=2)
-    d.addPairwiseEnergy(feats, compat=3,
-                        kernel=dcrf.DIAG_KERNEL,
-                        normalization=dcrf.NORMALIZE_SYMMETRIC)
-
-    # Run five inference steps.
-    Q = d.inference(5)
+    kwargs = {}
+    if 'lowres' == opt.mode:
+        kwargs = dict(scale=opt.scale)
+    elif 'band' == opt.mode:
+        kwargs = dict(margin=opt.margin, radius=opt.radius)
+    Q = crf_modes[opt.mode](img, probs, sdims=(80, 80), schan=(13, 13, 13), compat=3, n_iter=5, **kwargs)
 
     # Find out the most probable class for each pixel.
     # MAP = np.argmax(Q, axis=0)
     # bb = 1-MAP.reshape(img.shape[:2])
-    bb = np.array(Q)[0].reshape(img.shape[:2])
+    bb = Q[0]
     bb = (bb*255).astype(np.uint8)
     bb = Image.fromarray(bb)
     bb.save('%s/%s.png'%(output_root, img_name[:-4]))
+    return img_name
+
+
+if not os.path.exists(output_root):
+    os.mkdir(output_root)
+
+files = [name for name in os.listdir(img_root) if name.endswith('.jpg')]
+pool = CRFPool(opt.workers or None, chunksize=opt.chunk)
+for it, img_name in enumerate(pool.imap(refine, ((name,) for name in files))):
+    print('%d %s' % (it + 1, img_name))
+pool.close()
@@ -0,0 +1,42 @@
+import os
+import sys
+import pytest
+torch = pytest.importorskip('torch')
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import build_feature, Deconv
+from inference import prepare_inference, Affine
+
+
+@pytest.mark.parametrize('i', ['densenet', 'resnet18'])
+def test_folded_matches_eval(i):
+    # like bench_infer.py: statistics away from the identity
+    feature = build_feature(i, output_stride=8)
+    deconv = Deconv(i, 'full', 8)
+    for m in feature.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+    feature.eval()
+    deconv.eval()
+    net = prepare_inference(feature, deconv)
+    assert not [m for m in net.modules() if isinstance(m, nn.BatchNorm2d)]
+    if 'densenet' == i:
+        assert [m for m in net.modules() if isinstance(m, Affine)]
+    x = torch.randn(2, 3, 64, 64)
+    with torch.no_grad():
+        ref = torch.softmax(deconv(feature(x)), 1)
+        assert (net(x) - ref).abs().max().item() < 1e-4
+
+
+def test_densenet_loads_old_layer_names():
+    feature = build_feature('densenet', output_stride=8)
+    sd = feature.state_dict()
+    old = dict((k.replace('norm1.', 'norm.1.').replace('conv2.', 'conv.2.'), v.clone() + 1) for k, v in sd.items())
+    assert 'features.denseblock1.denselayer1.norm.1.weight' in old
+    feature.load_state_dict(old)
+    w = feature.features.denseblock1.denselayer1.norm1.weight
+    assert torch.equal(w, sd['features.denseblock1.denselayer1.norm1.weight'] + 1)
@@ -0,0 +1,67 @@
+import os
+import sys
+import pytest
+torch = pytest.importorskip('torch')
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import build_feature, Deconv
+import quant
+
+
+def float_model(i):
+    return build_feature(i, output_stride=8), Deconv(i, 'full', 8)
+
+
+@pytest.mark.parametrize('i', ['vgg', 'resnet'])
+def test_qat_step_and_convert(i):
+    feature, deconv = float_model(i)
+    feature.freeze(1)
+    net = quant.prepare_qat(feature, deconv)
+    optimizer = torch.optim.SGD([p for p in net.parameters() if p.requires_grad], lr=1e-3)
+    x = torch.randn(2, 3, 64, 64)
+    loss = F.cross_entropy(net(x), torch.randint(0, 2, (2, 8, 8)))
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    quant.freeze_qat(net)
+    int8 = quant.convert_int8(net)
+    assert int8(torch.randn(1, 3, 64, 64)).shape == (1, 2, 8, 8)
+
+
+@pytest.mark.parametrize('i', ['vgg', 'resnet'])
+def test_ptq_close_to_float(i):
+    feature, deconv = float_model(i)
+    feature.eval()
+    deconv.eval()
+    x = torch.randn(4, 3, 64, 64)
+    prepared = quant.calibrate(quant.prepare_ptq(feature, deconv), [x])
+    int8 = quant.convert_int8(prepared)
+    with torch.no_grad():
+        ref = torch.softmax(deconv(feature(x)), 1)
+    out = quant.Int8Net(int8)(x)
+    assert out.shape == ref.shape
+    assert (out - ref).abs().mean().item() < 0.05
+
+
+def test_stages_keep_state_dict_keys():
+    # the stages only list registered modules
+    feature = build_feature('resnet', output_stride=8)
+    names = set(feature.state_dict())
+    assert 'conv1.weight' in names and 'layer4.0.conv2.weight' in names
+    assert not [n for n in names if n.startswith('stage')]
+
+
+def test_int8_file_runs_like_test_py(tmp_path):
+    # calibrate.py writes the file, test.py --int8 loads it
+    feature, deconv = float_model('resnet18')
+    feature.eval()
+    deconv.eval()
+    x = torch.randn(2, 3, 64, 64)
+    int8 = quant.convert_int8(quant.calibrate(quant.prepare_ptq(feature, deconv), [x]))
+    filename = str(tmp_path / 'int8.pt')
+    quant.save_int8(int8, filename)
+    net = quant.Int8Net(quant.load_int8(filename))
+    out = net(x)
+    assert out.shape == (2, 2, 8, 8)
+    assert torch.allclose(out, quant.Int8Net(int8)(x))
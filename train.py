@@ -4,33 +4,53 @@ import torch.nn.functional as functional
 from torch.autograd import Variable
 import torchvision
 from dataset import MyBoxPixData
-from criterion import CrossEntropyLoss2d
-from model import Deconv
-from vgg import Vgg16
-from resnet import resnet50
-from densenet import densenet121
+from criterion import seg_losses
+from model import build_feature, Deconv
 from tensorboardX import SummaryWriter
 from datetime import datetime
 import os
-import glob
 import pdb
 from myfunc import make_image_grid
+import parallel
+from logger import MetricLogger
+from freeze import make_optimizer
+from checkpoint import Checkpointer
+from prune import load_pruned
+import quant
 import argparse
 from os.path import expanduser
 home = expanduser("~")
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--i', default='vgg')  # 'vgg' or 'resnet' or 'densenet'
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--seg_head', default='full')  # Deconv layers: 'full', 'sep' (separable fc6), 'slim' (256 channels) or 'aspp' (ASPP-lite)
 parser.add_argument('--q', default='')  # '' or 'pix' or 'box'
 parser.add_argument('--train_dir', default='%s/data/datasets/oxhand/train'%home)  # training dataset
 parser.add_argument('--check_dir', default='./parameters')  # save checkpoint parameters
-parser.add_argument('--f', default=None)
-parser.add_argument('--r', type=int, default=-1)  # latest checkpoint, set to -1 if don't need to load checkpoint
+parser.add_argument('--f', default=None)  # initial backbone weights (state dict or checkpoint, may be pruned)
+parser.add_argument('--d', default=None)  # initial Deconv weights (state dict or checkpoint, may be pruned, e.g. by bench_prune.py)
+parser.add_argument('--r', type=int, default=-1)  # resume from the checkpoint of this epoch, -1: start from scratch
 parser.add_argument('--b', type=int, default=48)  # batch size
 parser.add_argument('--e', type=int, default=20)  # epoches
+parser.add_argument('--dist', action='store_true')  # multi-process training, launch with torchrun
+parser.add_argument('--cpu', action='store_true')  # train on cpu even if cuda is available
+parser.add_argument('--log_every', type=int, default=20)  # print and log the mean losses (and images) every N steps
+parser.add_argument('--loss', default='full')  # segmentation loss on 'full' resolution logits, or 'down': at the resolution of Deconv against downsampled labels (same value, less memory)
+parser.add_argument('--freeze', type=int, default=0)  # backbone stages kept fixed, e.g. 3: vgg conv1-conv3, 2: resnet/densenet up to layer2/denseblock2
+parser.add_argument('--save_every', type=int, default=0)  # also checkpoint every N steps, 0: only at the end of epochs
+parser.add_argument('--save_min', type=float, default=0)  # also checkpoint every T minutes, 0: only at the end of epochs
+parser.add_argument('--qat', action='store_true')  # quantization aware fine-tuning of --f/--d (not densenet), exports check_dir/int8.pt
+parser.add_argument('--qat_freeze', type=int, default=0)  # with --qat, fix the quantization ranges and BatchNorm statistics from this epoch on, 0: never
+parser.add_argument('--backend', default='x86')  # quantized engine of --qat: 'x86' or 'fbgemm' (older cpus)
 # parser.add_argument('--lw', type=int, default=7)  # epoches
 opt = parser.parse_args()
-print(opt)
+
+if opt.dist:
+    parallel.init_distributed('gloo')
+device = parallel.get_device(opt.cpu)
+if parallel.is_main_process():
+    print(opt)
 
 label_weight = [1, 25]
 
@@ -59,57 +79,92 @@ mean = [.485, .456, .406]
 # if not os.path.exists('./runs'):
 #     os.mkdir('./runs')
 
-if not os.path.exists(check_dir):
+if parallel.is_main_process() and not os.path.exists(check_dir):
     os.mkdir(check_dir)
 
+logger = MetricLogger(None, '%s/metrics.csv' % check_dir, every=opt.log_every, active=parallel.is_main_process())
+
 # models
-if 'vgg' == opt.i:
-    feature = Vgg16(pretrained=True)
-elif 'resnet' == opt.i:
-    feature = resnet50(pretrained=True)
-elif 'densenet' == opt.i:
-    feature = densenet121(pretrained=True)
-feature.cuda()
+feature = build_feature(opt.i, pretrained=True, output_stride=opt.os)
+feature.to(device)
 if pretrained_feature_file:
-    feature.load_state_dict(torch.load(pretrained_feature_file))
-
-deconv = Deconv(opt.i)
-deconv.cuda()
-
-if resume_ep >= 0:
-    feature_param_file = glob.glob('%s/feature-epoch-%d*.pth'%(check_dir, resume_ep))
-    deconv_param_file = glob.glob('%s/deconv-epoch-%d*.pth'%(check_dir, resume_ep))
-    feature.load_state_dict(torch.load(feature_param_file[0]))
-    deconv.load_state_dict(torch.load(deconv_param_file[0]))
-
-train_loader = torch.utils.data.DataLoader(
+    load_pruned(feature, pretrained_feature_file, 'feature', device)
+# after loading, pruned convs get new parameters
+feature.freeze(opt.freeze)
+
+deconv = Deconv(opt.i, opt.seg_head, opt.os)
+deconv.to(device)
+if opt.d:
+    load_pruned(deconv, opt.d, 'deconv', device)
+
+if opt.qat:
+    # conv+bn+relu fused, fake quantization on weights and activations, one
+    # module: the checkpoints hold it as 'qat'
+    assert 'densenet' != opt.i, 'densenet cannot be quantized'
+    qat_net = quant.prepare_qat(feature, deconv, opt.backend).to(device)
+    models = {'qat': qat_net}
+    # fine-tuning a trained model, 10x lower learning rates
+    lrs = [(qat_net.feature, 1e-5), (qat_net.deconv, 1e-4)]
+    qat_net = parallel.wrap(qat_net, device)
+else:
+    models = {'feature': feature, 'deconv': deconv}
+    lrs = [(feature, 1e-4), (deconv, 1e-3)]
+    # no-op unless --dist
+    feature = parallel.wrap(feature, device)
+    deconv = parallel.wrap(deconv, device)
+
+train_loader = parallel.make_loader(
     MyBoxPixData(train_dir, transform=True, crop=True, hflip=True, vflip=False, source=opt.q),
     batch_size=bsize, shuffle=True, num_workers=4, pin_memory=True)
 
-criterion = CrossEntropyLoss2d(weight=torch.FloatTensor(label_weight))
-criterion.cuda()
-
-optimizer_deconv = torch.optim.Adam(deconv.parameters(), lr=1e-3)
-optimizer_feature = torch.optim.Adam(feature.parameters(), lr=1e-4)
+criterion = seg_losses[opt.loss](weight=torch.FloatTensor(label_weight))
+criterion.to(device)
 
+# a single optimizer, with the learning rate of every module in its own group
+optimizer = make_optimizer(lrs)
 
-for it in range(resume_ep+1, iter_num):
-    for ib, (data, lbl) in enumerate(train_loader):
-        inputs = Variable(data).cuda()
-        lbl = Variable(lbl.long()).cuda()
-        feats = feature(inputs)
-        msk = deconv(feats)
-        msk = functional.upsample(msk, scale_factor=8)
+# models, optimizers, rng and progress in one file, written in the background
+ckpt = Checkpointer(models, {'optimizer': optimizer},
+                    opt.save_every, opt.save_min)
+start_ep, start_ib = 0, 0
+if resume_ep >= 0:
+    progress = ckpt.resume(check_dir, resume_ep)
+    start_ep, start_ib = parallel.restore_loader(train_loader, progress.get('loader', {'epoch': resume_ep}))
+
+
+def save_checkpoint(it, ib):
+    # after batch ib of epoch it, a resume continues with the next batch
+    filename = ('%s/checkpoint-epoch-%d-step-%d.pth' % (check_dir, it, ib))
+    ckpt.save(filename, epoch=it, step=ib, loader=parallel.loader_state(train_loader, ib + 1))
+    if parallel.is_main_process():
+        print('save: (epoch: %d, step: %d)' % (it, ib))
+
+
+for it in range(start_ep, iter_num):
+    parallel.set_epoch(train_loader, it)
+    if opt.qat and 0 < opt.qat_freeze <= it:
+        quant.freeze_qat(qat_net)
+    for ib, (data, lbl) in enumerate(train_loader, start_ib):
+        inputs = Variable(data).to(device)
+        lbl = Variable(lbl.long()).to(device)
+        if opt.qat:
+            msk = qat_net(inputs)
+        else:
+            feats = feature(inputs)
+            msk = deconv(feats)
+            del feats
+        if 'full' == opt.loss:
+            msk = functional.upsample(msk, scale_factor=opt.os)
 
         loss = criterion(msk, lbl)
 
-        deconv.zero_grad()
-        feature.zero_grad()
+        optimizer.zero_grad()
 
         loss.backward()
 
-        optimizer_feature.step()
-        optimizer_deconv.step()
+        optimizer.step()
+        if ckpt.due():
+            save_checkpoint(it, ib)
         # if ib % 1 ==0:
         #     # visulize
         #     image = make_image_grid(inputs.data[:4, :3], mean, std)
@@ -122,14 +177,20 @@ for it in range(resume_ep+1, iter_num):
         #     mask1 = mask1.repeat(1, 3, 1, 1)
         #     writer.add_image('Label', torchvision.utils.make_grid(mask1), ib)
         #     writer.add_scalar('M_global', loss.data[0], ib)
-        print('loss: %.4f (epoch: %d, step: %d)' % (loss.data[0], it, ib))
-        del inputs, msk, lbl, loss, feats
+        logger.add(loss=loss)
+        logger.step(ib, epoch=it)
+        del inputs, msk, lbl, loss
         gc.collect()
 
-    filename = ('%s/deconv-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(deconv.state_dict(), filename)
-    filename = ('%s/feature-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(feature.state_dict(), filename)
-    print('save: (epoch: %d, step: %d)' % (it, ib))
+    logger.flush(ib, epoch=it)
+    start_ib = 0
+    save_checkpoint(it, ib)
+ckpt.close()
+logger.close()
+if opt.qat and parallel.is_main_process():
+    # the real int8 model, for the cpu
+    quant.save_int8(quant.convert_int8(models['qat']), '%s/int8.pt' % check_dir)
+    print('int8 model: %s/int8.pt' % check_dir)
+
 
 
@@ -5,32 +5,49 @@ import torch.nn.functional as functional
 from torch.autograd import Variable
 import torchvision
 from dataset import MyBoxPixData, MyClsData
-from criterion import CrossEntropyLoss2d
-from model import Classifier, Deconv
-from vgg import Vgg16
-from resnet import resnet50
-from densenet import densenet121
+from criterion import seg_losses
+from model import build_feature, classifiers, Deconv, fused_forward
 import torchvision.transforms as transforms
 from tensorboardX import SummaryWriter
 from datetime import datetime
 import os
-import glob
 import pdb
 from myfunc import make_image_grid
+import parallel
+from logger import MetricLogger
+from freeze import make_optimizer
+from checkpoint import Checkpointer
 import torchvision.datasets as datasets
 import argparse
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--i', default='vgg')  # 'vgg' or 'resnet' or 'densenet'
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--seg_head', default='full')  # Deconv layers: 'full', 'sep' (separable fc6), 'slim' (256 channels) or 'aspp' (ASPP-lite)
+parser.add_argument('--cls_head', default='linear')  # classifier head: 'linear' (fixed 256x256 input) or 'pooled' (pyramid pooling, any input size)
 parser.add_argument('--q', default='')  # '' or 'pix' or 'box'
 parser.add_argument('--cls_train_dir', default='/home/crow/data/datasets/oxhand/train')  # classification data
 parser.add_argument('--seg_train_dir', default='/home/crow/data/datasets/oxhand/train')  # segmentation data
 parser.add_argument('--check_dir', default='./parameters_alt')  # save checkpoint parameters
-parser.add_argument('--r', type=int, default=-1)  # latest checkpoint, set to -1 if don't need to load checkpoint
+parser.add_argument('--r', type=int, default=-1)  # resume from the checkpoint of this epoch, -1: start from scratch
 parser.add_argument('--b', type=int, default=16)  # batch size
 parser.add_argument('--e', type=int, default=20)  # training epoches
+parser.add_argument('--dist', action='store_true')  # multi-process training, launch with torchrun
+parser.add_argument('--cpu', action='store_true')  # train on cpu even if cuda is available
+parser.add_argument('--log_every', type=int, default=20)  # print and log the mean losses (and images) every N steps
+parser.add_argument('--loss', default='full')  # segmentation loss on 'full' resolution logits, or 'down': at the resolution of Deconv against downsampled labels (same value, less memory)
+parser.add_argument('--freeze', type=int, default=0)  # backbone stages kept fixed, e.g. 3: vgg conv1-conv3, 2: resnet/densenet up to layer2/denseblock2
+parser.add_argument('--save_every', type=int, default=0)  # also checkpoint every N steps, 0: only at the end of epochs
+parser.add_argument('--save_min', type=float, default=0)  # also checkpoint every T minutes, 0: only at the end of epochs
+parser.add_argument('--fuse', action='store_true')  # one backbone pass over the concatenated cls and seg batches
+parser.add_argument('--fuse_bn', default='split')  # with --fuse, 'split': per-batch BatchNorm statistics (same as two passes), 'joint': statistics over both batches
 opt = parser.parse_args()
-print(opt)
+
+if opt.dist:
+    parallel.init_distributed('gloo')
+device = parallel.get_device(opt.cpu)
+if parallel.is_main_process():
+    print(opt)
 
 resume_ep = opt.r
 cls_train_dir = opt.cls_train_dir
@@ -52,107 +69,128 @@ seg_label_weight = [1, 25]
 std = [.229, .224, .225]
 mean = [.485, .456, .406]
 
-os.system('rm -rf ./runs2/*')
-writer = SummaryWriter('./runs2/'+datetime.now().strftime('%B%d  %H:%M:%S'))
+writer = None
+if parallel.is_main_process():
+    os.system('rm -rf ./runs2/*')
+    writer = SummaryWriter('./runs2/'+datetime.now().strftime('%B%d  %H:%M:%S'))
+
+    if not os.path.exists('./runs2'):
+        os.mkdir('./runs2')
 
-if not os.path.exists('./runs2'):
-    os.mkdir('./runs2')
+    if not os.path.exists(check_dir):
+        os.mkdir(check_dir)
 
-if not os.path.exists(check_dir):
-    os.mkdir(check_dir)
+logger = MetricLogger(writer, '%s/metrics.csv' % check_dir, every=opt.log_every,
+                      mean=mean, std=std, active=parallel.is_main_process())
 
 # models
-if 'vgg' == opt.i:
-    feature = Vgg16(pretrained=True)
-elif 'resnet' == opt.i:
-    feature = resnet50(pretrained=True)
-elif 'densenet' == opt.i:
-    feature = densenet121(pretrained=True)
-feature.cuda()
+feature = build_feature(opt.i, pretrained=True, output_stride=opt.os)
+feature.to(device)
+feature.freeze(opt.freeze)
 
-classifier = Classifier(opt.i)
-classifier.cuda()
+classifier = classifiers[opt.cls_head](opt.i, output_stride=opt.os)
+classifier.to(device)
 
-deconv = Deconv(opt.i)
-deconv.cuda()
+deconv = Deconv(opt.i, opt.seg_head, opt.os)
+deconv.to(device)
 
-if resume_ep >= 0:
-    feature_param_file = glob.glob('%s/feature-epoch-%d*.pth'%(check_dir, resume_ep))
-    classifier_param_file = glob.glob('%s/classifier-epoch-%d*.pth'%(check_dir, resume_ep))
-    deconv_param_file = glob.glob('%s/deconv-epoch-%d*.pth'%(check_dir, resume_ep))
-    feature.load_state_dict(torch.load(feature_param_file[0]))
-    classifier.load_state_dict(torch.load(classifier_param_file[0]))
-    deconv.load_state_dict(torch.load(deconv_param_file[0]))
-
-cls_loader = torch.utils.data.DataLoader(
+cls_loader = parallel.make_loader(
     MyClsData(cls_train_dir, transform=True, crop=True, hflip=True, vflip=False),
     batch_size=bsize, shuffle=True, num_workers=4, pin_memory=True)
 
-seg_loader = torch.utils.data.DataLoader(
+seg_loader = parallel.make_loader(
     MyBoxPixData(seg_train_dir, transform=True, crop=True, hflip=True, vflip=False, source=opt.q),
     batch_size=bsize, shuffle=True, num_workers=4, pin_memory=True)
 
 criterion_cls = nn.CrossEntropyLoss(weight=torch.FloatTensor(cls_label_weight))
-criterion_cls.cuda()
+criterion_cls.to(device)
 
-criterion_seg = CrossEntropyLoss2d(weight=torch.FloatTensor(seg_label_weight))
-criterion_seg.cuda()
+criterion_seg = seg_losses[opt.loss](weight=torch.FloatTensor(seg_label_weight))
+criterion_seg.to(device)
 
-optimizer_classifier = torch.optim.Adam(classifier.parameters(), lr=1e-3)
-optimizer_deconv = torch.optim.Adam(deconv.parameters(), lr=1e-3)
-optimizer_feature = torch.optim.Adam(feature.parameters(), lr=1e-4)
+# a single optimizer, with the learning rate of every module in its own group
+optimizer = make_optimizer([(feature, 1e-4), (classifier, 1e-3), (deconv, 1e-3)])
 
+# models, optimizers, rng and progress in one file, written in the background
+ckpt = Checkpointer({'feature': feature, 'classifier': classifier, 'deconv': deconv},
+                    {'optimizer': optimizer},
+                    opt.save_every, opt.save_min)
+progress = {}
+start_ep, start_ib = 0, 0
+if resume_ep >= 0:
+    progress = ckpt.resume(check_dir, resume_ep)
+    start_ep, start_ib = parallel.restore_loader(cls_loader, progress.get('loader', {'epoch': resume_ep}))
+
+
+def save_checkpoint(it, ib):
+    # after batch ib of epoch it, a resume continues with the next batch
+    filename = ('%s/checkpoint-epoch-%d-step-%d.pth' % (check_dir, it, ib))
+    ckpt.save(filename, epoch=it, step=ib, loader=parallel.loader_state(cls_loader, ib + 1),
+              seg_loader=parallel.loader_state(seg_loader, ibs))
+    if parallel.is_main_process():
+        print('save: (epoch: %d, step: %d)' % (it, ib))
+
+def forward_step(cls_inputs, seg_inputs):
+    if opt.fuse:
+        cls_feats, seg_feats = fused_forward(feature, (cls_inputs, seg_inputs), 'split' == opt.fuse_bn)
+        return classifier(cls_feats), deconv(seg_feats)
+    feats = feature(cls_inputs)
+    output = classifier(feats)
+    feats = feature(seg_inputs)
+    msk = deconv(feats)
+    return output, msk
+
+# the backbone is shared by both losses, so the whole step is one DDP forward
+net = parallel.wrap(parallel.Step(forward_step, feature=feature, classifier=classifier, deconv=deconv), device)
+
+seg_ep, ibs = progress.get('seg_ep', 0), 0
+if 'seg_loader' in progress:
+    seg_ep, ibs = parallel.restore_loader(seg_loader, progress['seg_loader'])
+parallel.set_epoch(seg_loader, seg_ep)
 segIter = iter(seg_loader)
-ibs = 0
-for it in range(resume_ep+1, iter_num):
-    for ib, (data, lbl) in enumerate(cls_loader):
-        # train with classification data
-        inputs = Variable(data.float()).cuda()
-        lbl = Variable(lbl.long()).cuda()
-        feats = feature(inputs)
-        output = classifier(feats)
-        loss_cls = criterion_cls(output, lbl)
-
-        # train with segmentation data
-        data, lbl = segIter.next()
+for it in range(start_ep, iter_num):
+    parallel.set_epoch(cls_loader, it)
+    for ib, (data, lbl) in enumerate(cls_loader, start_ib):
+        # classification data
+        cls_inputs = Variable(data.float()).to(device)
+        cls_lbl = Variable(lbl.long()).to(device)
+
+        # segmentation data
+        data, lbl = next(segIter)
         ibs += 1
         if ibs >= len(segIter):
+            seg_ep += 1
+            parallel.set_epoch(seg_loader, seg_ep)
             segIter = iter(seg_loader)
             ibs = 0
-        inputs = Variable(data.float()).cuda()
-        lbl = Variable(lbl.long()).cuda()
-        feats = feature(inputs)
-        msk = deconv(feats)
-        msk = functional.upsample(msk, scale_factor=8)
+        seg_inputs = Variable(data.float()).to(device)
+        seg_lbl = Variable(lbl.long()).to(device)
+
+        output, msk = net(cls_inputs, seg_inputs)
+        loss_cls = criterion_cls(output, cls_lbl)
+        if 'full' == opt.loss:
+            msk = functional.upsample(msk, scale_factor=opt.os)
 
-        loss_seg = criterion_seg(msk, lbl)
+        loss_seg = criterion_seg(msk, seg_lbl)
 
-        classifier.zero_grad()
-        deconv.zero_grad()
-        feature.zero_grad()
+        optimizer.zero_grad()
         loss = loss_seg + loss_cls
         loss.backward()
 
-        optimizer_feature.step()
-        optimizer_classifier.step()
-        optimizer_deconv.step()
-        if ib % 20 ==0:
+        optimizer.step()
+        if ckpt.due():
+            save_checkpoint(it, ib)
+        logger.add(loss=loss, loss_cls=loss_cls, loss_seg=loss_seg)
+        if logger.due(ib):
             # visulize
-            image = make_image_grid(inputs.data[:4, :3], mean, std)
-            writer.add_image('Image', torchvision.utils.make_grid(image), ib)
-            msk = functional.softmax(msk)
-            mask1 = msk.data[:4, 1:2]
-            mask1 = mask1.repeat(1, 3, 1, 1)
-            writer.add_image('Image2', torchvision.utils.make_grid(mask1), ib)
-            writer.add_scalar('M_global', loss.data[0], ib)
-        print('loss: %.4f (epoch: %d, step: %d)' % (loss.data[0], it, ib))
-        del inputs, lbl, loss, feats
+            logger.image('Image', seg_inputs[:4, :3], ib)
+            logger.image('Image2', msk[:4], ib, 'prob')
+        logger.step(ib, epoch=it)
+        del cls_inputs, seg_inputs, cls_lbl, seg_lbl, loss
         gc.collect()
 
-    filename = ('%s/classifier-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(classifier.state_dict(), filename)
-    filename = ('%s/deconv-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(deconv.state_dict(), filename)
-    filename = ('%s/feature-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(feature.state_dict(), filename)
-    print('save: (epoch: %d, step: %d)' % (it, ib))
\ No newline at end of file
+    logger.flush(ib, epoch=it)
+    start_ib = 0
+    save_checkpoint(it, ib)
+ckpt.close()
+logger.close()
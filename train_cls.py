@@ -6,31 +6,44 @@ from torch.autograd import Variable
 import torchvision
 from dataset import MyData, MyClsData
 from criterion import CrossEntropyLoss2d
-from vgg import Vgg16
-from resnet import resnet50
-from densenet import densenet121
-from model import Classifier
+from model import build_feature, classifiers
 import torchvision.transforms as transforms
 from tensorboardX import SummaryWriter
 from datetime import datetime
 import os
-import glob
 import pdb
 from myfunc import make_image_grid
+import parallel
+from logger import MetricLogger
+from freeze import make_optimizer
+from checkpoint import Checkpointer
 import torchvision.datasets as datasets
 import argparse
 from os.path import expanduser
 home = expanduser("~")
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--i', default='vgg')  # 'vgg' or 'resnet' or 'densenet'
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--cls_head', default='linear')  # classifier head: 'linear' (fixed 256x256 input) or 'pooled' (pyramid pooling, any input size)
 parser.add_argument('--train_dir', default='%s/data/datasets/oxhand/train'%home)  # training dataset
 parser.add_argument('--check_dir', default='./parameters_cls')  # save checkpoint parameters
-parser.add_argument('--r', type=int, default=-1)  # latest checkpoint, set to -1 if don't need to load checkpoint
+parser.add_argument('--r', type=int, default=-1)  # resume from the checkpoint of this epoch, -1: start from scratch
 parser.add_argument('--b', type=int, default=38)  # batch size
 parser.add_argument('--e', type=int, default=20)  # training epoches
+parser.add_argument('--dist', action='store_true')  # multi-process training, launch with torchrun
+parser.add_argument('--cpu', action='store_true')  # train on cpu even if cuda is available
+parser.add_argument('--log_every', type=int, default=20)  # print and log the mean losses (and images) every N steps
+parser.add_argument('--freeze', type=int, default=0)  # backbone stages kept fixed, e.g. 3: vgg conv1-conv3, 2: resnet/densenet up to layer2/denseblock2
+parser.add_argument('--save_every', type=int, default=0)  # also checkpoint every N steps, 0: only at the end of epochs
+parser.add_argument('--save_min', type=float, default=0)  # also checkpoint every T minutes, 0: only at the end of epochs
 opt = parser.parse_args()
-print(opt)
+
+if opt.dist:
+    parallel.init_distributed('gloo')
+device = parallel.get_device(opt.cpu)
+if parallel.is_main_process():
+    print(opt)
 
 resume_ep = opt.r
 train_dir = opt.train_dir
@@ -43,69 +56,84 @@ label_weight = [9.81, 3.98]
 std = [.229, .224, .225]
 mean = [.485, .456, .406]
 
-os.system('rm -rf ./runs2/*')
-writer = SummaryWriter('./runs2/'+datetime.now().strftime('%B%d  %H:%M:%S'))
+writer = None
+if parallel.is_main_process():
+    os.system('rm -rf ./runs2/*')
+    writer = SummaryWriter('./runs2/'+datetime.now().strftime('%B%d  %H:%M:%S'))
+
+    if not os.path.exists('./runs2'):
+        os.mkdir('./runs2')
 
-if not os.path.exists('./runs2'):
-    os.mkdir('./runs2')
+    if not os.path.exists(check_dir):
+        os.mkdir(check_dir)
 
-if not os.path.exists(check_dir):
-    os.mkdir(check_dir)
+logger = MetricLogger(writer, '%s/metrics.csv' % check_dir, every=opt.log_every,
+                      mean=mean, std=std, active=parallel.is_main_process())
 
 # models
-if 'vgg' == opt.i:
-    feature = Vgg16(pretrained=True)
-elif 'resnet' == opt.i:
-    feature = resnet50(pretrained=True)
-elif 'densenet' == opt.i:
-    feature = densenet121(pretrained=True)
-feature.cuda()
+feature = build_feature(opt.i, pretrained=True, output_stride=opt.os)
+feature.to(device)
+feature.freeze(opt.freeze)
 
-classifier = Classifier(opt.i)
-classifier.cuda()
+classifier = classifiers[opt.cls_head](opt.i, output_stride=opt.os)
+classifier.to(device)
 
-if resume_ep >= 0:
-    feature_param_file = glob.glob('%s/feature-epoch-%d*.pth'%(check_dir, resume_ep))
-    classifier_param_file = glob.glob('%s/classifier-epoch-%d*.pth'%(check_dir, resume_ep))
-    feature.load_state_dict(torch.load(feature_param_file[0]))
-    classifier.load_state_dict(torch.load(classifier_param_file[0]))
+# no-op unless --dist
+feature = parallel.wrap(feature, device)
+classifier = parallel.wrap(classifier, device)
 
-train_loader = torch.utils.data.DataLoader(
+train_loader = parallel.make_loader(
     MyClsData(train_dir, transform=True, crop=True, hflip=True, vflip=False),
     batch_size=bsize, shuffle=True, num_workers=4, pin_memory=True)
 
 criterion = nn.CrossEntropyLoss(weight=torch.FloatTensor(label_weight))
-criterion.cuda()
+criterion.to(device)
+
+# a single optimizer, with the learning rate of every module in its own group
+optimizer = make_optimizer([(feature, 1e-4), (classifier, 1e-3)])
+
+# models, optimizers, rng and progress in one file, written in the background
+ckpt = Checkpointer({'feature': feature, 'classifier': classifier},
+                    {'optimizer': optimizer},
+                    opt.save_every, opt.save_min)
+start_ep, start_ib = 0, 0
+if resume_ep >= 0:
+    progress = ckpt.resume(check_dir, resume_ep)
+    start_ep, start_ib = parallel.restore_loader(train_loader, progress.get('loader', {'epoch': resume_ep}))
+
+
+def save_checkpoint(it, ib):
+    # after batch ib of epoch it, a resume continues with the next batch
+    filename = ('%s/checkpoint-epoch-%d-step-%d.pth' % (check_dir, it, ib))
+    ckpt.save(filename, epoch=it, step=ib, loader=parallel.loader_state(train_loader, ib + 1))
+    if parallel.is_main_process():
+        print('save: (epoch: %d, step: %d)' % (it, ib))
 
-optimizer_classifier = torch.optim.Adam(classifier.parameters(), lr=1e-3)
-optimizer_feature = torch.optim.Adam(feature.parameters(), lr=1e-4)
 
-for it in range(resume_ep+1, iter_num):
-    for ib, (data, lbl) in enumerate(train_loader):
-        inputs = Variable(data.float()).cuda()
-        lbl = Variable(lbl.long()).cuda()
+for it in range(start_ep, iter_num):
+    parallel.set_epoch(train_loader, it)
+    for ib, (data, lbl) in enumerate(train_loader, start_ib):
+        inputs = Variable(data.float()).to(device)
+        lbl = Variable(lbl.long()).to(device)
         feats = feature(inputs)
 
         output = classifier(feats)
         loss = criterion(output, lbl)
 
-        classifier.zero_grad()
-        feature.zero_grad()
+        optimizer.zero_grad()
 
         loss.backward()
 
-        optimizer_feature.step()
-        optimizer_classifier.step()
-        if ib % 20 ==0:
-            # image = make_image_grid(inputs.data[:4, :3], mean, std)
-            # writer.add_image('Image', torchvision.utils.make_grid(image), ib)
-            writer.add_scalar('M_global', loss.data[0], ib)
-        print('loss: %.4f (epoch: %d, step: %d)' % (loss.data[0], it, ib))
+        optimizer.step()
+        if ckpt.due():
+            save_checkpoint(it, ib)
+        logger.add(loss=loss)
+        logger.step(ib, epoch=it)
         del inputs, lbl, loss, feats
         gc.collect()
 
-    filename = ('%s/classifier-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(classifier.state_dict(), filename)
-    filename = ('%s/feature-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(feature.state_dict(), filename)
-    print('save: (epoch: %d, step: %d)' % (it, ib))
\ No newline at end of file
+    logger.flush(ib, epoch=it)
+    start_ib = 0
+    save_checkpoint(it, ib)
+ckpt.close()
+logger.close()
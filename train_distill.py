@@ -0,0 +1,222 @@
+import gc
+import torch
+import torch.nn as nn
+import torch.nn.functional as functional
+import torch.utils.data as data
+from dataset import MyBoxPixData
+from criterion import seg_losses
+from model import build_feature, feature_channels, Deconv
+from featstore import FeatureStore, build_feature_store, file_key
+import os
+import parallel
+from logger import MetricLogger
+from freeze import make_optimizer
+from checkpoint import Checkpointer
+from prune import load_pruned
+import argparse
+from os.path import expanduser
+home = expanduser("~")
+
+# train a (small) student backbone + Deconv on the labels and on the soft hand
+# probability maps of a fixed teacher model, optionally also matching the
+# teacher features through a 1x1 adapter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='mobilenet')  # student backbone: 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the student backbone: 8, 16 or 32
+parser.add_argument('--seg_head', default='full')  # student Deconv layers: 'full', 'sep', 'slim' or 'aspp'
+parser.add_argument('--t_i', default='vgg')  # teacher backbone
+parser.add_argument('--t_os', type=int, default=8)  # output stride of the teacher backbone
+parser.add_argument('--t_head', default='full')  # teacher Deconv layers
+parser.add_argument('--t_ckpt', default='')  # teacher training checkpoint, used instead of --t_feat and --t_deconv
+parser.add_argument('--t_feat', default='')  # teacher backbone weights
+parser.add_argument('--t_deconv', default='')  # teacher Deconv weights
+parser.add_argument('--alpha', type=float, default=0.5)  # weight of the soft targets, 1 - alpha: the labels
+parser.add_argument('--T', type=float, default=2.0)  # temperature of the soft targets
+parser.add_argument('--feat_w', type=float, default=0)  # weight of the feature matching loss, 0: off
+parser.add_argument('--cache', default='')  # directory for the teacher outputs, '': run the teacher every step
+parser.add_argument('--rebuild', action='store_true')  # recompute the teacher cache even if it matches
+parser.add_argument('--q', default='')  # '' or 'pix' or 'box'
+parser.add_argument('--train_dir', default='%s/data/datasets/oxhand/train'%home)  # training dataset
+parser.add_argument('--check_dir', default='./parameters_distill')  # save checkpoint parameters
+parser.add_argument('--r', type=int, default=-1)  # resume from the checkpoint of this epoch, -1: start from scratch
+parser.add_argument('--b', type=int, default=48)  # batch size
+parser.add_argument('--e', type=int, default=20)  # epoches
+parser.add_argument('--dist', action='store_true')  # multi-process training, launch with torchrun
+parser.add_argument('--dist_timeout', type=int, default=240)  # with --dist, minutes the other ranks wait for rank 0 to build the --cache
+parser.add_argument('--cpu', action='store_true')  # train on cpu even if cuda is available
+parser.add_argument('--log_every', type=int, default=20)  # print and log the mean losses (and images) every N steps
+parser.add_argument('--loss', default='full')  # label loss on 'full' resolution logits, or 'down': at the resolution of Deconv
+parser.add_argument('--freeze', type=int, default=0)  # student backbone stages kept fixed
+parser.add_argument('--save_every', type=int, default=0)  # also checkpoint every N steps, 0: only at the end of epochs
+parser.add_argument('--save_min', type=float, default=0)  # also checkpoint every T minutes, 0: only at the end of epochs
+opt = parser.parse_args()
+
+if opt.dist:
+    parallel.init_distributed('gloo', opt.dist_timeout)
+device = parallel.get_device(opt.cpu)
+if parallel.is_main_process():
+    print(opt)
+
+label_weight = [1, 25]
+check_dir = opt.check_dir
+resume_ep = opt.r
+
+if parallel.is_main_process() and not os.path.exists(check_dir):
+    os.mkdir(check_dir)
+
+logger = MetricLogger(None, '%s/metrics.csv' % check_dir, every=opt.log_every, active=parallel.is_main_process())
+
+
+class Teacher(nn.Module):
+    # logits of deconv, followed by the backbone features if `features`
+    def __init__(self, feature, deconv, features=False):
+        super(Teacher, self).__init__()
+        self.feature = feature
+        self.deconv = deconv
+        self.features = features
+
+    def forward(self, x):
+        feats = self.feature(x)
+        logits = self.deconv(feats)
+        return torch.cat([logits, feats], 1) if self.features else logits
+
+
+class WithTeacher(data.Dataset):
+    # the images and labels of dataset with the cached teacher outputs of the same index
+    def __init__(self, dataset, store):
+        super(WithTeacher, self).__init__()
+        self.dataset = dataset
+        self.store = store
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        img, lbl = self.dataset[index]
+        return img, lbl, self.store[index][0]
+
+
+# teacher, fixed
+t_feature = build_feature(opt.t_i, pretrained=False, output_stride=opt.t_os)
+t_feature.to(device)
+load_pruned(t_feature, opt.t_ckpt or opt.t_feat, 'feature', device)
+t_deconv = Deconv(opt.t_i, opt.t_head, opt.t_os)
+t_deconv.to(device)
+load_pruned(t_deconv, opt.t_ckpt or opt.t_deconv, 'deconv', device)
+teacher = Teacher(t_feature, t_deconv, opt.feat_w > 0).eval()
+for p in teacher.parameters():
+    p.requires_grad = False
+
+if opt.cache:
+    # the teacher outputs are computed once, on the images as they are; the
+    # only augmentation is a horizontal flip of image, labels and outputs
+    train_data = MyBoxPixData(opt.train_dir, transform=True, crop=False, hflip=False, vflip=False, source=opt.q)
+    meta = {'t_i': opt.t_i, 't_os': opt.t_os, 't_head': opt.t_head, 'features': opt.feat_w > 0,
+            't': file_key(opt.t_ckpt or opt.t_feat), 't_deconv': None if opt.t_ckpt else file_key(opt.t_deconv),
+            'q': opt.q, 'num': len(train_data)}
+    if parallel.is_main_process() and (opt.rebuild or not FeatureStore.matches(opt.cache, meta)):
+        build_feature_store(teacher, train_data, opt.cache, device, batch_size=opt.b, meta=meta)
+    # the other ranks wait for the cache
+    parallel.broadcast_object(None)
+    train_data = WithTeacher(train_data, FeatureStore(opt.cache))
+    teacher.cpu()
+else:
+    train_data = MyBoxPixData(opt.train_dir, transform=True, crop=True, hflip=True, vflip=False, source=opt.q)
+
+# student
+feature = build_feature(opt.i, pretrained=True, output_stride=opt.os)
+feature.to(device)
+feature.freeze(opt.freeze)
+deconv = Deconv(opt.i, opt.seg_head, opt.os)
+deconv.to(device)
+models = {'feature': feature, 'deconv': deconv}
+lrs = [(feature, 1e-4), (deconv, 1e-3)]
+if opt.feat_w > 0:
+    # student features -> teacher channels
+    adapter = nn.Conv2d(feature_channels[opt.i], feature_channels[opt.t_i], kernel_size=1)
+    adapter.to(device)
+    models['adapter'] = adapter
+    lrs.append((adapter, 1e-3))
+
+# no-op unless --dist
+feature = parallel.wrap(feature, device)
+deconv = parallel.wrap(deconv, device)
+if opt.feat_w > 0:
+    adapter = parallel.wrap(adapter, device)
+
+train_loader = parallel.make_loader(train_data, batch_size=opt.b, shuffle=True, num_workers=4, pin_memory=True)
+
+criterion = seg_losses[opt.loss](weight=torch.FloatTensor(label_weight))
+criterion.to(device)
+
+optimizer = make_optimizer(lrs)
+
+ckpt = Checkpointer(models, {'optimizer': optimizer}, opt.save_every, opt.save_min)
+start_ep, start_ib = 0, 0
+if resume_ep >= 0:
+    progress = ckpt.resume(check_dir, resume_ep)
+    start_ep, start_ib = parallel.restore_loader(train_loader, progress.get('loader', {'epoch': resume_ep}))
+
+
+def save_checkpoint(it, ib):
+    # after batch ib of epoch it, a resume continues with the next batch
+    filename = ('%s/checkpoint-epoch-%d-step-%d.pth' % (check_dir, it, ib))
+    ckpt.save(filename, epoch=it, step=ib, loader=parallel.loader_state(train_loader, ib + 1))
+    if parallel.is_main_process():
+        print('save: (epoch: %d, step: %d)' % (it, ib))
+
+
+def soft_loss(logits, target, T):
+    # KL divergence to the teacher probabilities at temperature T, mean over pixels
+    target = functional.interpolate(target, size=logits.shape[2:], mode='bilinear', align_corners=False)
+    kl = functional.kl_div(functional.log_softmax(logits / T, 1), functional.log_softmax(target / T, 1),
+                           reduction='none', log_target=True)
+    return kl.sum(1).mean() * T * T
+
+
+for it in range(start_ep, opt.e):
+    parallel.set_epoch(train_loader, it)
+    for ib, batch in enumerate(train_loader, start_ib):
+        inputs = batch[0].to(device)
+        lbl = batch[1].long().to(device)
+        if opt.cache:
+            target = batch[2].to(device).float()
+            flip = torch.rand(inputs.size(0), device=device) < 0.5
+            inputs = torch.where(flip.view(-1, 1, 1, 1), inputs.flip(3), inputs)
+            lbl = torch.where(flip.view(-1, 1, 1), lbl.flip(2), lbl)
+            target = torch.where(flip.view(-1, 1, 1, 1), target.flip(3), target)
+        else:
+            with torch.no_grad():
+                target = teacher(inputs)
+        feats = feature(inputs)
+        msk = deconv(feats)
+        soft = soft_loss(msk, target[:, :2], opt.T)
+        if 'full' == opt.loss:
+            hard = criterion(functional.upsample(msk, scale_factor=opt.os), lbl)
+        else:
+            hard = criterion(msk, lbl)
+        loss = (1 - opt.alpha) * hard + opt.alpha * soft
+        losses = {'hard': hard, 'soft': soft}
+        if opt.feat_w > 0:
+            hint = adapter(feats)
+            t_feats = functional.interpolate(target[:, 2:], size=hint.shape[2:], mode='bilinear', align_corners=False)
+            hint = functional.mse_loss(hint, t_feats)
+            loss = loss + opt.feat_w * hint
+            losses['hint'] = hint
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if ckpt.due():
+            save_checkpoint(it, ib)
+        logger.add(loss=loss, **losses)
+        logger.step(ib, epoch=it)
+        del inputs, msk, lbl, loss, feats, target
+        gc.collect()
+
+    logger.flush(ib, epoch=it)
+    start_ib = 0
+    save_checkpoint(it, ib)
+ckpt.close()
+logger.close()
@@ -0,0 +1,128 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as functional
+from dataset import MyBoxPixData, MyClsData
+from criterion import seg_losses
+from model import build_feature, Deconv, classifiers
+from featstore import FeatureStore, build_feature_store, file_key
+import os
+import parallel
+from logger import MetricLogger
+from checkpoint import Checkpointer
+from prune import load_pruned
+from freeze import make_optimizer
+import argparse
+from os.path import expanduser
+home = expanduser("~")
+
+# train Deconv or Classifier alone on top of a frozen backbone: the backbone
+# features are computed once into a memory-mapped fp16 store and every epoch
+# only runs the head
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--seg_head', default='full')  # Deconv layers: 'full', 'sep' (separable fc6), 'slim' (256 channels) or 'aspp' (ASPP-lite)
+parser.add_argument('--cls_head', default='linear')  # classifier head: 'linear' (fixed 256x256 input) or 'pooled' (pyramid pooling, any input size)
+parser.add_argument('--task', default='seg')  # 'seg': train Deconv on MyBoxPixData, 'cls': train Classifier on MyClsData
+parser.add_argument('--q', default='')  # '' or 'pix' or 'box', segmentation data
+parser.add_argument('--train_dir', default='%s/data/datasets/oxhand/train'%home)  # training dataset
+parser.add_argument('--check_dir', default='./parameters_head')  # save checkpoint parameters
+parser.add_argument('--f', default=None)  # backbone weights (state dict or training checkpoint, may be pruned), kept fixed
+parser.add_argument('--cache', default='')  # feature store directory, default check_dir/feats
+parser.add_argument('--copies', type=int, default=0)  # augmented copies of every image in the store, 0: one un-augmented copy
+parser.add_argument('--rebuild', action='store_true')  # recompute the feature store even if it matches
+parser.add_argument('--r', type=int, default=-1)  # resume from the checkpoint of this epoch, -1: start from scratch
+parser.add_argument('--b', type=int, default=48)  # batch size
+parser.add_argument('--e', type=int, default=20)  # epoches
+parser.add_argument('--cpu', action='store_true')  # train on cpu even if cuda is available
+parser.add_argument('--log_every', type=int, default=20)  # print and log the mean losses (and images) every N steps
+parser.add_argument('--loss', default='full')  # segmentation loss on 'full' resolution logits, or 'down': at the resolution of Deconv against downsampled labels (same value, less memory)
+parser.add_argument('--save_every', type=int, default=0)  # also checkpoint every N steps, 0: only at the end of epochs
+parser.add_argument('--save_min', type=float, default=0)  # also checkpoint every T minutes, 0: only at the end of epochs
+opt = parser.parse_args()
+print(opt)
+
+device = parallel.get_device(opt.cpu)
+check_dir = opt.check_dir
+cache_dir = opt.cache or '%s/feats' % check_dir
+resume_ep = opt.r
+
+if not os.path.exists(check_dir):
+    os.mkdir(check_dir)
+
+logger = MetricLogger(None, '%s/metrics.csv' % check_dir, every=opt.log_every)
+
+# models
+feature = build_feature(opt.i, pretrained=True, output_stride=opt.os)
+feature.to(device)
+if opt.f:
+    load_pruned(feature, opt.f, 'feature', device)
+feature.eval()
+for p in feature.parameters():
+    p.requires_grad = False
+
+# backbone features, computed once
+augment = opt.copies > 0
+if 'seg' == opt.task:
+    train_data = MyBoxPixData(opt.train_dir, transform=True, crop=augment, hflip=augment, vflip=False, source=opt.q)
+else:
+    train_data = MyClsData(opt.train_dir, transform=True, crop=augment, hflip=augment, vflip=False)
+meta = {'i': opt.i, 'os': opt.os, 'f': file_key(opt.f), 'task': opt.task, 'q': opt.q,
+        'copies': opt.copies, 'num': len(train_data)}
+if opt.rebuild or not FeatureStore.matches(cache_dir, meta):
+    build_feature_store(feature, train_data, cache_dir, device, copies=max(opt.copies, 1),
+                        batch_size=opt.b, meta=meta)
+feature.cpu()
+train_loader = parallel.make_loader(FeatureStore(cache_dir), batch_size=opt.b, shuffle=True,
+                                    num_workers=2, pin_memory=True)
+
+if 'seg' == opt.task:
+    name, head = 'deconv', Deconv(opt.i, opt.seg_head, opt.os)
+    criterion = seg_losses[opt.loss](weight=torch.FloatTensor([1, 25]))
+else:
+    name, head = 'classifier', classifiers[opt.cls_head](opt.i, output_stride=opt.os)
+    criterion = nn.CrossEntropyLoss(weight=torch.FloatTensor([9.81, 3.98]))
+head.to(device)
+criterion.to(device)
+
+optimizer = make_optimizer([(head, 1e-3)])
+
+# the backbone goes along, so that test.py --ckpt can use the checkpoints
+ckpt = Checkpointer({'feature': feature, name: head}, {name: optimizer}, opt.save_every, opt.save_min)
+start_ep, start_ib = 0, 0
+if resume_ep >= 0:
+    progress = ckpt.resume(check_dir, resume_ep)
+    start_ep, start_ib = parallel.restore_loader(train_loader, progress.get('loader', {'epoch': resume_ep}))
+
+
+def save_checkpoint(it, ib):
+    # after batch ib of epoch it, a resume continues with the next batch
+    filename = ('%s/checkpoint-epoch-%d-step-%d.pth' % (check_dir, it, ib))
+    ckpt.save(filename, epoch=it, step=ib, loader=parallel.loader_state(train_loader, ib + 1))
+    print('save: (epoch: %d, step: %d)' % (it, ib))
+
+
+for it in range(start_ep, opt.e):
+    parallel.set_epoch(train_loader, it)
+    for ib, (feats, lbl) in enumerate(train_loader, start_ib):
+        feats = feats.to(device)
+        lbl = lbl.long().to(device)
+        output = head(feats)
+        if 'seg' == opt.task and 'full' == opt.loss:
+            output = functional.upsample(output, scale_factor=opt.os)
+        loss = criterion(output, lbl)
+
+        head.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if ckpt.due():
+            save_checkpoint(it, ib)
+        logger.add(loss=loss)
+        logger.step(ib, epoch=it)
+        del feats, lbl, output, loss
+    logger.flush(ib, epoch=it)
+    start_ib = 0
+    save_checkpoint(it, ib)
+ckpt.close()
+logger.close()
@@ -3,32 +3,77 @@ import torch
 import torch.nn.functional as functional
 from torch.autograd import Variable
 import torchvision
-from dataset import MyClsBoxPixData
-from criterion import CrossEntropyLoss2d
-from model import Deconv
-from vgg import Vgg16
-from resnet import resnet50
-from densenet import densenet121
+from dataset import MyClsBoxPixData, Indexed
+from criterion import seg_losses
+from model import build_feature, Deconv
 from tensorboardX import SummaryWriter
 from datetime import datetime
 import os
-import glob
 import numpy as np
 import pdb
 from myfunc import make_image_grid, crf_func, avg_func
+import parallel
+from logger import MetricLogger
+from freeze import make_optimizer
+from checkpoint import Checkpointer, load_weights
+from crf import CRFPool
+from plabel import PseudoLabelStore, PseudoLabelTeacher, make_pseudo_labels, async_pseudo_labels
 import argparse
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--i', default='vgg')  # 'vgg' or 'resnet' or 'densenet'
+parser.add_argument('--i', default='vgg')  # 'vgg', 'resnet' (50), 'densenet', 'resnet18', 'resnet34' or 'mobilenet'
+parser.add_argument('--os', type=int, default=8)  # output stride of the backbone: 8, 16 or 32 (faster)
+parser.add_argument('--seg_head', default='full')  # Deconv layers: 'full', 'sep' (separable fc6), 'slim' (256 channels) or 'aspp' (ASPP-lite)
 parser.add_argument('--q', default='')  # '' or 'pix' or 'box'
 parser.add_argument('--train_dir', default='/home/crow/data/datasets/oxhand/train')  # training dataset
 parser.add_argument('--check_dir', default='./parameters_with_cls')  # save checkpoint parameters
 parser.add_argument('--f', default=None)
-parser.add_argument('--r', type=int, default=49)  # latest checkpoint, set to -1 if don't need to load checkpoint
+parser.add_argument('--r', type=int, default=49)  # resume from the checkpoint of this epoch, -1: start from scratch
 parser.add_argument('--b', type=int, default=8)  # batch size
 parser.add_argument('--e', type=int, default=100)  # epoches
+parser.add_argument('--dist', action='store_true')  # multi-process training, launch with torchrun
+parser.add_argument('--cpu', action='store_true')  # train on cpu even if cuda is available
+parser.add_argument('--log_every', type=int, default=20)  # print and log the mean losses (and images) every N steps
+parser.add_argument('--loss', default='full')  # segmentation loss on 'full' resolution logits, or 'down': at the resolution of Deconv against downsampled labels (same value, less memory)
+parser.add_argument('--freeze', type=int, default=0)  # backbone stages kept fixed, e.g. 3: vgg conv1-conv3, 2: resnet/densenet up to layer2/denseblock2
+parser.add_argument('--save_every', type=int, default=0)  # also checkpoint every N steps, 0: only at the end of epochs
+parser.add_argument('--save_min', type=float, default=0)  # also checkpoint every T minutes, 0: only at the end of epochs
+parser.add_argument('--pl_every', type=int, default=0)  # reuse pseudo labels for this many epochs, 0: regenerate every batch
+parser.add_argument('--pl_ckpt', action='store_true')  # also regenerate pseudo labels after every checkpoint
+parser.add_argument('--pl_cache', default=None)  # file to persist the pseudo labels in, default check_dir/plabels.npz
+parser.add_argument('--pl_async', action='store_true')  # generate pseudo labels ahead of time in a teacher process
+parser.add_argument('--pl_depth', type=int, default=4)  # with --pl_async, batches labelled ahead of training
+parser.add_argument('--pl_sync', type=int, default=100)  # with --pl_async, steps between weight syncs to the teacher
+parser.add_argument('--pl_device', default='cpu')  # with --pl_async, device of the teacher
+parser.add_argument('--pl_threads', type=int, default=0)  # with --pl_async, cpu threads of the teacher, 0: torch default
+parser.add_argument('--tta_num', type=int, default=8)  # random crops per flip when averaging pseudo labels
+parser.add_argument('--tta_seed', type=int, default=None)  # fixed crop positions for reproducible pseudo labels
+parser.add_argument('--crf', default='dense')  # pseudo-label refinement: 'dense' (pydensecrf), 'conv' (batched convcrf) or 'guided' (guided filter), the last two on the training device
+parser.add_argument('--crf_workers', type=int, default=0)  # processes running the pseudo-label CRF, 0: in the training loop
+parser.add_argument('--crf_mode', default='full')  # pseudo-label CRF: 'full', 'lowres' (half resolution) or 'band' (uncertain pixels only)
 opt = parser.parse_args()
-print(opt)
+
+
+def build_models(pretrained=False):
+    feature = build_feature(opt.i, pretrained=pretrained, output_stride=opt.os)
+    return feature, Deconv(opt.i, opt.seg_head, opt.os)
+
+teacher = None
+if opt.pl_async:
+    # forked before this process touches CUDA, labels go through the cache
+    teacher = PseudoLabelTeacher(build_models, opt.pl_device, opt.pl_depth, opt.pl_sync,
+                                 opt.tta_num, opt.tta_seed, opt.pl_threads, opt.crf_workers, opt.crf_mode, opt.crf)
+    opt.pl_every = max(opt.pl_every, 1)
+
+crf_pool = None
+if teacher is None and 'dense' == opt.crf:
+    crf_pool = CRFPool(opt.crf_workers, mode=opt.crf_mode)
+
+if opt.dist:
+    parallel.init_distributed('gloo')
+device = parallel.get_device(opt.cpu)
+if parallel.is_main_process():
+    print(opt)
 
 label_weight = [1, 25]
 
@@ -49,54 +94,97 @@ iter_num = opt.e  # training iterations
 std = [.229, .224, .225]
 mean = [.485, .456, .406]
 
-os.system('rm -rf ./runs/*')
-writer = SummaryWriter('./runs/'+datetime.now().strftime('%B%d  %H:%M:%S'))
+writer = None
+if parallel.is_main_process():
+    os.system('rm -rf ./runs/*')
+    writer = SummaryWriter('./runs/'+datetime.now().strftime('%B%d  %H:%M:%S'))
 
-if not os.path.exists('./runs'):
-    os.mkdir('./runs')
+    if not os.path.exists('./runs'):
+        os.mkdir('./runs')
 
-if not os.path.exists(check_dir):
-    os.mkdir(check_dir)
+    if not os.path.exists(check_dir):
+        os.mkdir(check_dir)
 
-# models
-if 'vgg' == opt.i:
-    feature = Vgg16(pretrained=True)
-elif 'resnet' == opt.i:
-    feature = resnet50(pretrained=True)
-elif 'densenet' == opt.i:
-    feature = densenet121(pretrained=True)
-feature.cuda()
+logger = MetricLogger(writer, '%s/metrics.csv' % check_dir, every=opt.log_every,
+                      mean=mean, std=std, active=parallel.is_main_process())
 
-deconv = Deconv(opt.i)
-deconv.cuda()
+# models
+feature, deconv = build_models(pretrained=True)
+feature.to(device)
+feature.freeze(opt.freeze)
+deconv.to(device)
 
 if pretrained_feature_file:
-    feature.load_state_dict(torch.load(pretrained_feature_file))
+    load_weights(feature, pretrained_feature_file, 'feature', device)
+
+# pseudo labels are inferred with the plain modules, so they don't go through DDP
+feature_raw = feature
+deconv_raw = deconv
+# no-op unless --dist
+feature = parallel.wrap(feature, device)
+deconv = parallel.wrap(deconv, device)
 
+train_data = MyClsBoxPixData(train_dir, transform=True, crop=True, hflip=True, vflip=False, source=opt.q)
+train_loader = parallel.make_loader(
+    Indexed(train_data),
+    batch_size=bsize, shuffle=True, num_workers=4, pin_memory=True)
+
+# positive images are not augmented (only resized), so their pseudo labels
+# can be cached per sample index and reused across epochs
+pl_store = None
+if opt.pl_every > 0:
+    pl_store = PseudoLabelStore(train_data.img_names, every=opt.pl_every)
+    pl_file = opt.pl_cache or '%s/plabels.npz' % check_dir
+    if parallel.is_distributed():
+        # ranks see different shards, each keeps its own store
+        pl_file = '%s.rank%d' % (pl_file, parallel.get_rank())
+    if resume_ep >= 0 and os.path.exists(pl_file):
+        print('pseudo labels: %d loaded from %s' % (pl_store.load(pl_file), pl_file))
+
+criterion = seg_losses[opt.loss](weight=torch.FloatTensor(label_weight))
+criterion.to(device)
+
+# a single optimizer, with the learning rate of every module in its own group
+optimizer = make_optimizer([(feature, 1e-4), (deconv, 1e-3)])
 
+# models, optimizers, rng and progress in one file, written in the background
+ckpt = Checkpointer({'feature': feature, 'deconv': deconv},
+                    {'optimizer': optimizer},
+                    opt.save_every, opt.save_min)
+start_ep, start_ib = 0, 0
 if resume_ep >= 0:
-    feature_param_file = glob.glob('%s/feature-epoch-%d*.pth'%(check_dir, resume_ep))
-    deconv_param_file = glob.glob('%s/deconv-epoch-%d*.pth'%(check_dir, resume_ep))
-    feature.load_state_dict(torch.load(feature_param_file[0]))
-    deconv.load_state_dict(torch.load(deconv_param_file[0]))
+    progress = ckpt.resume(check_dir, resume_ep)
+    start_ep, start_ib = parallel.restore_loader(train_loader, progress.get('loader', {'epoch': resume_ep}))
 
-train_loader = torch.utils.data.DataLoader(
-    MyClsBoxPixData(train_dir, transform=True, crop=True, hflip=True, vflip=False, source=opt.q),
-    batch_size=bsize, shuffle=True, num_workers=4, pin_memory=True)
 
-criterion = CrossEntropyLoss2d(weight=torch.FloatTensor(label_weight))
-criterion.cuda()
+def save_checkpoint(it, ib):
+    # after batch ib of epoch it, a resume continues with the next batch
+    filename = ('%s/checkpoint-epoch-%d-step-%d.pth' % (check_dir, it, ib))
+    ckpt.save(filename, epoch=it, step=ib, loader=parallel.loader_state(train_loader, ib + 1))
+    if pl_store is not None and opt.pl_ckpt:
+        # labels made before this checkpoint are stale, also after a resume from it
+        pl_store.bump()
+        if teacher is not None:
+            # labels of the new version come from the current weights
+            teacher.sync(feature_raw, deconv_raw, teacher.steps, pl_store.version)
+    if pl_store is not None:
+        pl_store.save(pl_file)
+    if parallel.is_main_process():
+        print('save: (epoch: %d, step: %d)' % (it, ib))
 
-optimizer_deconv = torch.optim.Adam(deconv.parameters(), lr=1e-3)
-optimizer_feature = torch.optim.Adam(feature.parameters(), lr=1e-4)
 
+if teacher is not None:
+    teacher.sync(feature_raw, deconv_raw, 0, pl_store.version)
 
-for it in range(resume_ep+1, iter_num):
-    for ib, (data, lbl) in enumerate(train_loader):
+for it in range(start_ep, iter_num):
+    parallel.set_epoch(train_loader, it)
+    batches = train_loader
+    if teacher is not None:
+        batches = async_pseudo_labels(train_loader, teacher, pl_store, it)
+    for ib, (idx, data, lbl) in enumerate(batches, start_ib):
         lbl = lbl.long()
-        if lbl.max() == 2:
+        if teacher is None and lbl.max() == 2:
             sb = (lbl[:, 0, 0] == 2).nonzero().view(-1)
-            pseudo_inputs = Variable(data[sb, :, :, :]).cuda()
             ## CRF
             # feats = feature(pseudo_inputs)
             # pseudo_lbl = deconv(feats)
@@ -111,52 +199,61 @@ for it in range(resume_ep+1, iter_num):
             # pseudo_lbl[pseudo_lbl<=0.2] = 0
             # lbl[sb, :, :] = pseudo_lbl.long()
             ## Avg
-            pseudo_lbl = avg_func(feature, deconv, pseudo_inputs, 8)
-            pseudo_lbl = pseudo_lbl.cpu().numpy()
-            imgs = data[sb, :, :, :].numpy()
-            pseudo_lbl = crf_func(imgs.transpose(0, 2, 3, 1), np.stack((1 - pseudo_lbl, pseudo_lbl), 1))
-            pseudo_lbl = torch.from_numpy(pseudo_lbl[:, 1])
-
-            pseudo_lbl[pseudo_lbl>=0.5] = 1
-            pseudo_lbl[pseudo_lbl<0.5] = 0
-            lbl[sb, :, :] = pseudo_lbl.long()
+            if pl_store is None:
+                pseudo_lbl = make_pseudo_labels(feature_raw, deconv_raw, data[sb], device, opt.tta_num, opt.tta_seed, crf_pool, opt.crf)
+            else:
+                sb_idx = idx[sb].numpy()
+                stale = pl_store.stale(sb_idx, it)
+                if stale.any():
+                    pl_store.put(sb_idx[stale], make_pseudo_labels(
+                        feature_raw, deconv_raw, data[sb[torch.from_numpy(stale.nonzero()[0])]], device, opt.tta_num, opt.tta_seed, crf_pool, opt.crf), it)
+                pseudo_lbl = pl_store.get(sb_idx)
+            lbl[sb, :, :] = torch.from_numpy(pseudo_lbl).long()
 
-        lbl = Variable(lbl).cuda()
-        inputs = Variable(data).cuda()
+        lbl = Variable(lbl).to(device)
+        inputs = Variable(data).to(device)
 
         feats = feature(inputs)
 
         msk = deconv(feats)
-        msk = functional.upsample(msk, scale_factor=8)
+        if 'full' == opt.loss:
+            msk = functional.upsample(msk, scale_factor=opt.os)
 
         loss = criterion(msk, lbl)
 
-        deconv.zero_grad()
-        feature.zero_grad()
+        optimizer.zero_grad()
 
         loss.backward()
 
-        optimizer_feature.step()
-        optimizer_deconv.step()
+        optimizer.step()
+        if teacher is not None:
+            teacher.step(feature_raw, deconv_raw)
 
-        if ib % 20 ==0:
+        if ckpt.due():
+            save_checkpoint(it, ib)
+        logger.add(loss=loss)
+        if logger.due(ib):
             # visulize
-            image = make_image_grid(inputs.data[:4, :3], mean, std)
-            writer.add_image('Image', torchvision.utils.make_grid(image), ib)
-            msk = functional.softmax(msk)
-            mask1 = msk.data[:4, 1:2]
-            mask1 = mask1.repeat(1, 3, 1, 1)
-            writer.add_image('Image2', torchvision.utils.make_grid(mask1), ib)
-            mask1 = lbl.data[:4].unsqueeze(1).float()
-            mask1 = mask1.repeat(1, 3, 1, 1)
-            writer.add_image('Label', torchvision.utils.make_grid(mask1), ib)
-            writer.add_scalar('M_global', loss.data[0], ib)
-        print('loss: %.4f (epoch: %d, step: %d)' % (loss.data[0], it, ib))
+            logger.image('Image', inputs[:4, :3], ib)
+            logger.image('Image2', msk[:4], ib, 'prob')
+            logger.image('Label', lbl[:4], ib, 'mask')
+            if teacher is not None:
+                logger.scalars(ib, **dict(('teacher/%s' % k, v) for k, v in teacher.stats().items()))
+        logger.step(ib, epoch=it)
         del inputs, msk, lbl, loss, feats
         gc.collect()
 
-    filename = ('%s/deconv-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(deconv.state_dict(), filename)
-    filename = ('%s/feature-epoch-%d-step-%d.pth' % (check_dir, it, ib))
-    torch.save(feature.state_dict(), filename)
-    print('save: (epoch: %d, step: %d)' % (it, ib))
\ No newline at end of file
+    if pl_store is not None:
+        print('pseudo labels: %d cached, %d reused, %d generated' % (len(pl_store), pl_store.hits, pl_store.misses))
+        pl_store.hits = pl_store.misses = 0
+        if teacher is not None:
+            print('teacher: %s' % teacher.stats())
+
+    logger.flush(ib, epoch=it)
+    start_ib = 0
+    save_checkpoint(it, ib)
+ckpt.close()
+logger.close()
+
+if teacher is not None:
+    teacher.close()
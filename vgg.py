@@ -4,11 +4,19 @@ import torch.nn.functional as F
 import torchvision
 from torch.nn import init
 import pdb
+from freeze import Freezable
 
 
-class Vgg16(nn.Module):
-    def __init__(self, pretrained=True):
+class Vgg16(Freezable, nn.Module):
+    # end of conv1, ..., conv5 in self.main
+    stage_ends = (5, 10, 17, 24, 31)
+
+    def __init__(self, pretrained=True, output_stride=8):
         super(Vgg16, self).__init__()
+        assert output_stride in (8, 16, 32), 'output_stride 8, 16 or 32'
+        self.output_stride = output_stride
+        # conv5 is dilated by the pooling it skips
+        d = 2 if 8 == output_stride else 1
         self.main = nn.Sequential(
             # conv1
             nn.Conv2d(3, 64, 3, padding=1),
@@ -37,15 +45,17 @@ class Vgg16(nn.Module):
             nn.ReLU(),
             nn.Conv2d(512, 512, 3, padding=1),
             nn.ReLU(),
-            nn.MaxPool2d(1, stride=1, ceil_mode=True),  # 1/16
+            nn.MaxPool2d(1, stride=1, ceil_mode=True) if 8 == output_stride else
+            nn.MaxPool2d(2, stride=2, ceil_mode=True),  # 1/8 or 1/16
             # conv5 features
-            nn.Conv2d(512, 512, 3, padding=2, dilation=2),
+            nn.Conv2d(512, 512, 3, padding=d, dilation=d),
             nn.ReLU(),
-            nn.Conv2d(512, 512, 3, padding=2, dilation=2),
+            nn.Conv2d(512, 512, 3, padding=d, dilation=d),
             nn.ReLU(),
-            nn.Conv2d(512, 512, 3, padding=2, dilation=2),
+            nn.Conv2d(512, 512, 3, padding=d, dilation=d),
             nn.ReLU(),
-            nn.MaxPool2d(kernel_size=3, stride=1, padding=1, ceil_mode=True)  # 1/16
+            nn.MaxPool2d(kernel_size=3, stride=1, padding=1, ceil_mode=True) if output_stride < 32 else
+            nn.MaxPool2d(2, stride=2, ceil_mode=True)  # output_stride
         )
         vgg16 = torchvision.models.vgg16(pretrained=pretrained)
         L_vgg16 = list(vgg16.features)
@@ -58,5 +68,8 @@ class Vgg16(nn.Module):
                 l2.weight.data = l1.weight.data
                 l2.bias.data = l1.bias.data
 
+    def stages(self):
+        return [list(self.main[b:e]) for b, e in zip((0,) + self.stage_ends[:-1], self.stage_ends)]
+
     def forward(self, x):
-        return self.main(x)
\ No newline at end of file
+        return self.run_stages(x)
\ No newline at end of file